@@ -0,0 +1,177 @@
+"""
+Benchmark of testcase upload to a judge server: time and bytes on the wire of every wire format.
+A local endpoint acks each testcase like a judge server, behind a proxy that adds latency and limits bandwidth.
+
+    python benchmark.py --bandwidth 100 --latency 10 --window 16
+"""
+
+import argparse
+import asyncio
+import collections
+import importlib.util
+import json
+import os
+import random
+import time
+
+import websockets
+
+
+def load_frame():
+    """
+    Load judge/frame.py alone, importing the judge package would read ./data/config.json and connect the database
+    """
+    spec = importlib.util.spec_from_file_location("frame", os.path.join(os.path.dirname(__file__), "judge", "frame.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+frame = load_frame()
+
+
+def numbers(count: int, size: int) -> list[tuple[bytes, bytes]]:
+    """
+    Typical text testcases: lines of integers, and a short answer
+    """
+    tests = []
+    for _ in range(count):
+        line = " ".join(str(random.randint(-10 ** 9, 10 ** 9)) for _ in range(size // 11 + 1))
+        tests.append((line[:size].encode(), str(random.randint(0, 10 ** 18)).encode()))
+    return tests
+
+
+def binary(count: int, size: int) -> list[tuple[bytes, bytes]]:
+    return [(os.urandom(size), os.urandom(16)) for _ in range(count)]
+
+
+testsets = {
+    "small": lambda scale: numbers(500 * scale, 100),
+    "numbers": lambda scale: numbers(50 * scale, 200_000),
+    "large": lambda scale: numbers(2, 10_000_000 * scale),
+    "binary": lambda scale: binary(10 * scale, 1_000_000),
+}
+
+# Wire format: binary frames, permessage-deflate, frame compression threshold
+modes = {
+    "json": (False, False, 0),
+    "json+deflate": (False, True, 0),
+    "frames": (True, False, 0),
+    "frames+zlib": (True, False, 65536),
+    "frames+deflate": (True, True, 0),
+}
+
+
+async def judge_server(ws):
+    """
+    Ack every testcase by index, as a judge server does once it is written
+    """
+    async for message in ws:
+        if isinstance(message, bytes):
+            _, indexes, payloads = frame.decode(message)
+        else:
+            command, tests = json.loads(message)
+            indexes = [tests[0]] if command == "command.testcase" else [test[0] for test in tests]
+
+        for i in indexes:
+            await ws.send(json.dumps(["judge.write:testcase", {"status": 0, "index": i}]))
+
+
+async def proxy(listen: int, target: int, bandwidth: float, latency: float, sent: list[int]):
+    """
+    Forward TCP both ways, delayed by latency seconds and limited to bandwidth bytes per second.
+    sent[0] counts the bytes from the client.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, count: bool):
+        queue = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                at, chunk = await queue.get()
+                if chunk is None:
+                    writer.close()
+                    return
+                await asyncio.sleep(max(0.0, at - loop.time()))
+                writer.write(chunk)
+                await writer.drain()
+
+        task = asyncio.create_task(deliver())
+        free_at = 0.0
+        while chunk := await reader.read(65536):
+            if count:
+                sent[0] += len(chunk)
+            free_at = max(free_at, loop.time()) + len(chunk) / bandwidth
+            await queue.put((free_at + latency, chunk))
+        await queue.put((0, None))
+        await task
+
+    async def handle(client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target)
+        await asyncio.gather(pipe(client_reader, server_writer, True),
+                             pipe(server_reader, client_writer, False),
+                             return_exceptions=True)
+
+    return await asyncio.start_server(handle, "127.0.0.1", listen)
+
+
+async def upload(uri: str, tests: list[tuple[bytes, bytes]], mode: str, window: int) -> float:
+    binary_frames, deflate, threshold = modes[mode]
+    async with websockets.connect(uri, compression="deflate" if deflate else None, max_size=None) as ws:
+        started = time.monotonic()
+
+        in_flight = collections.deque()
+        for i, (input_content, output_content) in enumerate(tests, 1):
+            if binary_frames:
+                message = frame.encode("command.testcase", [i], [input_content, output_content], threshold)
+            else:
+                # How the content went before frames, bytes that are not UTF-8 get mangled
+                message = json.dumps(["command.testcase", [i,
+                                                           input_content.decode(errors="replace"),
+                                                           output_content.decode(errors="replace")]])
+            await ws.send(message)
+            in_flight.append(i)
+
+            if len(in_flight) >= window:
+                await ws.recv()
+                in_flight.popleft()
+
+        while len(in_flight) > 0:
+            await ws.recv()
+            in_flight.popleft()
+
+        return time.monotonic() - started
+
+
+async def main(args: argparse.Namespace):
+    server = await websockets.serve(judge_server, "127.0.0.1", args.port, max_size=None)
+    sent = [0]
+    link = await proxy(args.port + 1, args.port, args.bandwidth * 125_000, args.latency / 1000, sent)
+
+    print(f"{'testset':<10}{'mode':<16}{'content MB':>12}{'wire MB':>10}{'ratio':>8}{'seconds':>10}")
+    for name in args.testsets:
+        tests = testsets[name](args.scale)
+        size = sum(len(input_content) + len(output_content) for input_content, output_content in tests)
+
+        for mode in args.modes:
+            sent[0] = 0
+            elapsed = await upload(f"ws://127.0.0.1:{args.port + 1}", tests, mode, args.window)
+            print(f"{name:<10}{mode:<16}{size / 1e6:>12.2f}{sent[0] / 1e6:>10.2f}"
+                  f"{sent[0] / size:>8.2f}{elapsed:>10.2f}")
+
+    link.close()
+    server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark testcase upload to a judge server")
+    parser.add_argument("--bandwidth", type=float, default=100, help="link bandwidth in Mbit/s")
+    parser.add_argument("--latency", type=float, default=10, help="one way latency in ms")
+    parser.add_argument("--window", type=int, default=16, help="testcases in flight")
+    parser.add_argument("--scale", type=int, default=1, help="multiply the size of the testsets")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--testsets", nargs="+", choices=testsets.keys(), default=list(testsets.keys()))
+    parser.add_argument("--modes", nargs="+", choices=modes.keys(), default=list(modes.keys()))
+    random.seed(0)
+    asyncio.run(main(parser.parse_args()))
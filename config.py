@@ -22,7 +22,7 @@ translate = {
         "pass_store": ["plain", "hashed"],
         "hash_func": ["argon2", "scrypt", "sha512", "sha256"],
         "testcase_strict": ["strict", "loose"],
-        "judge_mode": [1, 0],
+        "judge_mode": [1, 0, 2],
         "compress_threshold": [],
     },
     "vi": {
@@ -52,6 +52,7 @@ translate = {
             [
                 "Đa luồng - Chia đều các test cho các luồng",
                 "Đa luồng - Mỗi luồng chạy một bài nộp",
+                "Tự động - Chọn cách chia cho từng bài nộp",
             ],
         ],
         "compress_threshold": [
@@ -87,6 +88,7 @@ translate = {
             [
                 "Multi - Evenly distribute tests to threads",
                 "Multi - Each thread runs a submission",
+                "Adaptive - Choose how to split for each submission",
             ],
         ],
         "compress_threshold": [
@@ -10,7 +10,10 @@ from . import (
     declare,
     exception,
     redis,
-    operator
+    memory,
+    operator,
+    archive,
+    manifest
 )
 from .declare import (
     Problems,
@@ -33,9 +36,12 @@ __all__ = [
     "file",
     "sql",
     "redis",
+    "memory",
     "declare",
     "exception",
     "operator",
+    "archive",
+    "manifest",
     # Problems
     "Problems",
     "DBProblems",
@@ -66,6 +72,8 @@ __all__ = [
     "get_log_ids",
     "dump_logs",
     "get_logs",
+    "iter_logs",
+    "convert_logs",
     # Users
     "User",
     "UpdateUser",
@@ -138,6 +146,8 @@ update_submission: typing.Callable[[str, UpdateSubmissions], DBSubmissions] = ge
 get_log_ids: typing.Callable[[str], typing.List[str]] = get("get_log_ids")
 dump_logs: typing.Callable[[str, str, list[str]], None] = get("dump_logs")
 get_logs: typing.Callable[[str, str], SubmissionLog] = get("get_logs")
+iter_logs: typing.Callable[[str, str], typing.Iterator[typing.Any]] = get("iter_logs")
+convert_logs: typing.Callable[[], int] = get("convert_logs")
 
 """
 User
@@ -173,6 +183,11 @@ queue_manager: redis.QueueManager = None
 
 async def setup_redis():
     global redis_client, queue_manager
+    if utils.config.queue_backend == "memory":
+        queue_manager = memory.MemoryQueueManager()
+        logger.info("Using in-memory queues, judge queue will not survive a restart")
+        return
+
     redis_client = redis_.asyncio.Redis.from_url(utils.config.redis_server)
     try:
         await redis_client.ping()  # noqa
@@ -186,7 +201,11 @@ async def setup_redis():
         logger.exception(error)
         redis_client = None
     else:
-        queue_manager = redis.QueueManager(redis_client)
+        queue_manager = (
+            redis.StreamQueueManager(redis_client)
+            if utils.config.queue_backend == "stream" else
+            redis.QueueManager(redis_client)
+        )
         logger.info(f"Connected to Redis: {utils.config.redis_server}")
 
 
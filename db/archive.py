@@ -0,0 +1,35 @@
+"""
+Compact format for archived submission logs: gzip-compressed JSON lines, one log entry per line
+"""
+
+import gzip
+import io
+import json
+import typing
+
+extension = ".jsonl.gz"
+
+
+def encode(logs: list) -> bytes:
+    return gzip.compress(
+        "\n".join(json.dumps(log, separators=(",", ":"), ensure_ascii=False) for log in logs).encode(),
+        compresslevel=6
+    )
+
+
+def iter_decode(file: typing.BinaryIO) -> typing.Iterator[typing.Any]:
+    """
+    Decode entries one by one, without loading the whole archive
+    """
+    with gzip.GzipFile(fileobj=file, mode="rb") as archive:
+        for line in archive:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_decode_bytes(data: bytes) -> typing.Iterator[typing.Any]:
+    return iter_decode(io.BytesIO(data))
+
+
+def decode(data: bytes) -> list:
+    return list(iter_decode_bytes(data))
@@ -12,6 +12,7 @@ import utils
 from declare import Limit, JudgeMode, Indexable
 from utils import config
 from .exception import ProblemNotFound, InvalidTestcaseExtension, InvalidTestcaseCount, ProblemTestcaseAlreadyExist
+from . import manifest
 from .logging import logger
 
 
@@ -30,6 +31,7 @@ class Problems(Indexable):
     mode: JudgeMode = sqlmodel.Field(sa_column=sqlmodel.Column(sqlmodel.JSON))
     point_per_testcase: float = sqlmodel.Field(default=1.0)
     judger: str | None = sqlmodel.Field(default=None)
+    stop_on_first_failure: bool = sqlmodel.Field(default=False)
 
     roles: typing.List[str] = sqlmodel.Field(
         sa_column=sqlmodel.Column(sqlmodel.JSON),
@@ -214,3 +216,5 @@ def unzip_testcases(problem: DBProblems, upfile: UploadFile, overwrite: bool = F
 
     shutil.rmtree(unzip_dir)
     os.remove(os.path.join(problem["dir"], zip_file))
+
+    manifest.build(problem)
@@ -3,6 +3,7 @@ For file system-stored type
 """
 
 import ast
+import datetime
 import json
 import os
 import os.path as path
@@ -14,6 +15,7 @@ from fastapi import UploadFile
 import declare
 import utils
 from utils import read_json, write_json
+from . import archive
 from .declare import (
     files_dir,
     problems_json,
@@ -334,35 +336,83 @@ def update_submission(id: str, submission: UpdateSubmissions):
 
 def get_log_ids(submission_id: str) -> typing.List[str]:
     submission = get_submission(submission_id)
-    return ([f.replace(".json", "") for f in os.listdir(path.join(submission.dir, "logs")) if f.endswith(".json")]
-            if path.exists(path.join(submission.dir, "logs")) else [])
+    logs_dir = path.join(submission.dir, "logs")
+    if not path.exists(logs_dir):
+        return []
+    return ([f.removesuffix(archive.extension) for f in os.listdir(logs_dir) if f.endswith(archive.extension)] +
+            [f.removesuffix(".json") for f in os.listdir(logs_dir) if f.endswith(".json")])
 
 
-def dump_logs(submission_id: str, id: str, logs: str):
+def dump_logs(submission_id: str, id: str, logs: list):
     if id in get_log_ids(submission_id):
         raise SubmissionLogAlreadyExist(id)
 
-    log = SubmissionLog(
-        id=id,
-        submission=submission_id,
-        logs=logs
-    )
     submission = get_submission(submission_id)
-    # print("dumping")
-    with open(f"{submission.dir}/logs/{id}.json", "w") as f:
-        # print("opened file")
-        f.write(log.model_dump_json(indent=4))
-    # print("dumped")
+    with open(f"{submission.dir}/logs/{id}{archive.extension}", "wb") as f:
+        f.write(archive.encode(logs))
+
+
+def iter_logs(submission_id: str, id: str) -> typing.Iterator[typing.Any]:
+    submission = get_submission(submission_id)
+    if id not in get_log_ids(submission_id):
+        raise SubmissionLogNotFound(id)
+
+    archived = f"{submission.dir}/logs/{id}{archive.extension}"
+    if path.exists(archived):
+        def iterator():
+            with open(archived, "rb") as f:
+                yield from archive.iter_decode(f)
+
+        return iterator()
+
+    with open(f"{submission.dir}/logs/{id}.json", "r") as f:
+        return iter(SubmissionLog(**json.load(f)).logs)
 
 
 def get_logs(submission_id: str, id: str) -> SubmissionLog:
     submission = get_submission(submission_id)
     if id not in get_log_ids(submission_id):
         raise SubmissionLogNotFound(id)
+
+    archived = f"{submission.dir}/logs/{id}{archive.extension}"
+    if path.exists(archived):
+        with open(archived, "rb") as f:
+            return SubmissionLog(
+                id=id,
+                submission=submission_id,
+                logs=list(archive.iter_decode(f)),
+                created_at=str(datetime.datetime.fromtimestamp(path.getmtime(archived)))
+            )
+
     with open(f"{submission.dir}/logs/{id}.json", "r") as f:
         return SubmissionLog(**json.load(f))
 
 
+def convert_logs() -> int:
+    """
+    Convert logs stored as JSON to the archive format, return the number of converted logs
+    """
+    converted = 0
+    for submission_id in get_submission_ids():
+        submission = get_submission(submission_id)
+        logs_dir = path.join(submission.dir, "logs")
+        if not path.exists(logs_dir):
+            continue
+
+        for file in os.listdir(logs_dir):
+            if not file.endswith(".json"):
+                continue
+
+            with open(path.join(logs_dir, file), "r") as f:
+                log = SubmissionLog(**json.load(f))
+            with open(path.join(logs_dir, file.removesuffix(".json") + archive.extension), "wb") as f:
+                f.write(archive.encode(log.logs))
+            os.remove(path.join(logs_dir, file))
+            converted += 1
+
+    return converted
+
+
 """
 User
 """
@@ -0,0 +1,52 @@
+"""
+Content hashes of a problem's testcases
+"""
+
+import hashlib
+import json
+import os
+
+import utils
+
+manifest_name = "manifest.json"
+
+
+def manifest_file(problem) -> str:
+    # Next to the testcases, so replacing the testcases also drops the manifest
+    return os.path.join(problem.dir, "testcases", manifest_name)
+
+
+def hash_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def build(problem) -> dict[str, list[str]]:
+    """
+    Hash every testcase as index -> [input sha256, output sha256], and store it next to the testcases
+    """
+    test_dir = os.path.join(problem.dir, "testcases")
+    manifest = {
+        str(index): [
+            hash_file(os.path.join(test_dir, str(index), problem.test_name[0])),
+            hash_file(os.path.join(test_dir, str(index), problem.test_name[1]))
+        ]
+        for index in range(1, problem.total_testcases + 1)
+    }
+    utils.write_json(manifest_file(problem), manifest)
+    return manifest
+
+
+def get(problem) -> dict[str, list[str]]:
+    if os.path.exists(manifest_file(problem)):
+        return utils.read_json(manifest_file(problem))
+    if not os.path.exists(os.path.join(problem.dir, "testcases")):
+        return {}
+    return build(problem)
+
+
+def digest(problem) -> str:
+    """
+    A single hash of the whole testcase set
+    """
+    return hashlib.sha256(json.dumps(get(problem), sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,106 @@
+"""
+In-process queues, for installs without Redis
+"""
+
+import collections
+import fnmatch
+import json
+import sys
+import time
+import typing
+
+import utils
+from . import exception
+from .redis import RedisQueue, QueueManager
+
+
+class MemoryQueue(RedisQueue):
+    items: collections.deque
+    closed_at: float | None = None
+
+    def __init__(self, name: str, from_cache: bool = False, maxlen: int = None):
+        super().__init__(None, name, from_cache, maxlen)
+        self.items = collections.deque(maxlen=maxlen)
+
+    async def put(self, item: typing.Any, non_event: bool = False, json_decode: bool = True):
+        self.items.append(item)
+
+        if non_event or self.closed or not self.events['put']:
+            return
+
+        if json_decode:
+            try:
+                item = json.dumps(item)
+            except (TypeError, json.JSONDecodeError):
+                pass
+        await self.emit('put', item)
+
+    async def get(self):
+        return self.items[-1] if self.items else None
+
+    async def get_all(self):
+        return list(self.items)
+
+    async def close(self, non_event: bool = False):
+        if not self.closed:
+            self.closed_at = time.time()
+        await self.shutdown(non_event)
+
+    async def empty(self):
+        return len(self.items) == 0
+
+
+class MemoryQueueManager(QueueManager):
+    def __init__(self):
+        super().__init__(None)
+
+    def connect(self, client: typing.Any = None):
+        pass
+
+    def create(self, name: str, maxlen: int = None):
+        if self.check(name):
+            raise exception.QueueAlreadyExist(name)
+        queue = MemoryQueue(name, maxlen=maxlen)
+        self.queues[name] = queue
+        return queue
+
+    def add(self, queue: RedisQueue, skip_check: bool = False):
+        if not isinstance(queue, MemoryQueue):
+            raise exception.QueueNotValid(type(queue))
+        super().add(queue, skip_check)
+
+    def check(self, name: str):
+        return name in self.queues and not self.queues[name].closed
+
+    async def check_cache(self, name: str):
+        return name in self.queues and len(self.queues[name].items) > 0
+
+    async def get_cache(self, name: str):
+        if not await self.check_cache(name):
+            raise exception.QueueNotFound(name)
+        return self.queues[name]
+
+    async def close(self, name: str):
+        await self.get(name).close()
+
+    async def sweep(self, pattern: str = "judge::*", keep: set[str] = None) -> tuple[int, int]:
+        keep = keep or set()
+        deadline = time.time() - utils.config.queue_ttl
+
+        names = [
+            name for name, queue in self.queues.items()
+            if fnmatch.fnmatch(name, pattern) and name not in keep and
+            queue.closed_at is not None and queue.closed_at < deadline
+        ]
+
+        reclaimed = 0
+        for name in names:
+            queue = self.queues.pop(name)
+            reclaimed += sum(sys.getsizeof(item) for item in queue.items)
+
+        return len(names), reclaimed
+
+    async def stop(self):
+        for queue in self.queues.values():
+            await queue.close()
+        self.queues.clear()
@@ -1,82 +1,198 @@
 import json
+import time
 import typing
 import logging
 
 import asyncio
 import redis.asyncio as redis
 
+import utils
 from . import exception
+from .logging import logger
+
+closed_key = "justyse:queues:closed"
+
+
+class Subscriber:
+    """
+    A listener of a single queue, with its own bounded buffer and delivery task
+    """
+    func: typing.Callable
+    buffer: asyncio.Queue
+    task: asyncio.Task = None
+
+    def __init__(self, func: typing.Callable, size: int = None):
+        self.func = func
+        self.buffer = asyncio.Queue(maxsize=size if size is not None else utils.config.queue_buffer_size)
+        self.task = asyncio.create_task(self.deliver())
+
+    async def deliver(self):
+        while True:
+            calls = await self.buffer.get()
+            try:
+                for args, kwargs in calls:
+                    if asyncio.iscoroutinefunction(self.func):
+                        await self.func(*args, **kwargs)
+                    else:
+                        self.func(*args, **kwargs)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as error:
+                logger.error(f"Listener {self.func.__name__} raise exception, detail")
+                logger.exception(error)
+
+            finally:
+                self.buffer.task_done()
+
+    async def push(self, *args, **kwargs):
+        await self.push_batch([(args, kwargs)])
+
+    async def push_batch(self, calls: list[tuple[tuple, dict]]):
+        """
+        Wait for a free slot in the buffer, so a slow listener slows the producer down
+        """
+        await asyncio.wait_for(self.buffer.put(calls), timeout=utils.config.send_timeout)
+
+    async def drain(self):
+        await asyncio.wait_for(self.buffer.join(), timeout=utils.config.send_timeout)
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
 
 
 class RedisQueue:
     client: redis.Redis
     name: str
+    maxlen: int | None = None
     closed: bool = False
     events: dict[
-        typing.Literal['get', 'put', 'close', 'get_all'],
-        # list[tuple[typing.Callable, asyncio.AbstractEventLoop]]
-        dict[str, typing.Callable]
-    ] = {
-        # 'get': [],
-        # 'get_all': [],
-        'put': {},
-        'close': {},
-    }
+        typing.Literal['put', 'close'],
+        dict[int, Subscriber]
+    ]
     logger: logging.Logger
 
-    def __init__(self, client: redis.Redis, name: str, from_cache: bool = False):
+    _pending: list[tuple[str, bool]]
+    _flusher: asyncio.Task = None
+    _flush_lock: asyncio.Lock
+
+    def __init__(self, client: redis.Redis, name: str, from_cache: bool = False, maxlen: int = None):
         self.client = client
         self.name = name
+        self.maxlen = maxlen
+        self.events = {
+            'put': {},
+            'close': {},
+        }
+        self._pending = []
+        self._flush_lock = asyncio.Lock()
         if from_cache:
             self.closed = True
 
         # self.logger = logging.getLogger(f"justyse.rq.{name}")
         # self.logger.addHandler(utils.console_handler(f"RQ:{name}"))
 
-    def on(self, event: typing.Literal['get', 'put']):
+    def on(self, event: typing.Literal['put', 'close']):
         def warper(func: typing.Callable):
             id_ = id(func)
             if not self.closed:
-                self.events[event][id_] = func
+                self.events[event][id_] = Subscriber(func)
             return id_
 
         return warper
 
-    def off(self, key: str):
+    async def off(self, key: int):
         for event in self.events.keys():
             if key in self.events[event]:
-                self.events[event].pop(key)
+                await self.events[event].pop(key).stop()
                 break
 
-    def off_(self, event: typing.Literal['put', 'close']):
+    async def off_(self, event: typing.Literal['put', 'close']):
+        for subscriber in self.events[event].values():
+            await subscriber.stop()
         self.events[event].clear()
 
-    def offs(self):
+    async def offs(self):
         for key in self.events.keys():
-            self.off_(key)
+            await self.off_(key)
 
     async def emit(self, event: typing.Literal['put', 'close'], *args, **kwargs):
+        await self.emit_batch(event, [(args, kwargs)])
+
+    async def emit_batch(self, event: typing.Literal['put', 'close'], calls: list[tuple[tuple, dict]]):
         if self.closed:
             return
 
-        for func in self.events[event].values():
-            if asyncio.iscoroutinefunction(func):
-                await func(*args, **kwargs)
-            else:
-                func(*args, **kwargs)
+        for key, subscriber in list(self.events[event].items()):
+            try:
+                await subscriber.push_batch(calls)
+            except asyncio.TimeoutError:
+                logger.warning(f"Listener {subscriber.func.__name__} of {self.name} is too slow, removed")
+                await self.off(key)
 
     async def put(self, item: typing.Any, non_event: bool = False, json_decode: bool = True):
+        """
+        Items put within queue_batch_delay milliseconds are written and announced together
+        """
+        if self.closed:
+            return
+
         if json_decode:
             try:
                 item = json.dumps(item)
             except (TypeError, json.JSONDecodeError):
                 pass
 
-        await self.client.rpush(self.name, item)
-        if not non_event:
-            await self.emit('put', item)
+        self._pending.append((item, non_event))
+        if utils.config.queue_batch_delay <= 0 or len(self._pending) >= utils.config.queue_buffer_size:
+            return await self.flush()
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(utils.config.queue_batch_delay / 1000)
+        try:
+            await self.flush()
+        except Exception as error:
+            logger.error(f"Flush queue {self.name} raise exception, detail")
+            logger.exception(error)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+
+            try:
+                await self._write(pending)
+            except Exception:
+                # Written by the next flush, ahead of the items put meanwhile
+                self._pending = pending + self._pending
+                raise
+            await self._notify([item for item, non_event in pending if not non_event])
+
+    async def _write(self, pending: list[tuple[str, bool]]):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.rpush(self.name, *[item for item, _ in pending])
+            if self.maxlen is not None:
+                pipe.ltrim(self.name, -self.maxlen, -1)
+            await pipe.execute()
+
+    async def _notify(self, items: list[str]):
+        if items:
+            await self.emit_batch('put', [((item,), {}) for item in items])
 
     async def get(self):
+        await self.flush()
         item = await self.client.lrange(self.name, -1, -1)
         try:
             item = json.loads(item)
@@ -85,6 +201,7 @@ class RedisQueue:
         return item
 
     async def get_all(self):
+        await self.flush()
         items = await self.client.lrange(self.name, 0, -1)
         try:
             items = [json.loads(item) for item in items]
@@ -98,30 +215,51 @@ class RedisQueue:
         return await asyncio.to_thread(db.dump_logs, submission_id, self.name, await self.get_all())
 
     async def close(self, non_event: bool = False):
+        await self.flush()
+        if not self.closed:
+            await self.client.zadd(closed_key, {self.name: time.time()})
+        await self.shutdown(non_event)
+
+    async def shutdown(self, non_event: bool = False):
+        """
+        Deliver what is left to local listeners, then detach them
+        """
         if not non_event:
+            for subscriber in list(self.events['put'].values()):
+                try:
+                    await subscriber.drain()
+                except asyncio.TimeoutError:
+                    pass
             await self.emit('close')
+            for subscriber in list(self.events['close'].values()):
+                try:
+                    await subscriber.drain()
+                except asyncio.TimeoutError:
+                    pass
         self.closed = True
-        self.offs()
+        await self.offs()
 
     async def empty(self):
+        await self.flush()
         return await self.client.llen(self.name) == 0
 
 
 class QueueManager:
     client: redis.Redis = None
-    queues: dict[str, RedisQueue] = {}
+    queues: dict[str, RedisQueue]
 
     def __init__(self, client: redis.Redis = None):
+        self.queues = {}
         if client is not None:
             self.connect(client)
 
     def connect(self, client: redis.Redis):
         self.client = client
 
-    def create(self, name: str):
+    def create(self, name: str, maxlen: int = None):
         if self.check(name):
             raise exception.QueueAlreadyExist(name)
-        queue = RedisQueue(self.client, name)
+        queue = RedisQueue(self.client, name, maxlen=maxlen)
         self.queues[name] = queue
         return queue
 
@@ -143,6 +281,18 @@ class QueueManager:
             raise exception.QueueNotFound(name)
         return self.queues[name]
 
+    def release(self, name: str):
+        """
+        Forget a queue without closing it, another process writes to it from now on
+        """
+        self.queues.pop(name, None)
+
+    async def exists(self, name: str):
+        return self.check(name)
+
+    async def open(self, name: str) -> RedisQueue:
+        return self.get(name)
+
     async def check_cache(self, name: str):
         if self.client is None:
             raise exception.NotConnected()
@@ -164,9 +314,234 @@ class QueueManager:
         queue = self.get(name)
         await queue.close()
 
+    async def sweep(self, pattern: str = "judge::*", keep: set[str] = None) -> tuple[int, int]:
+        """
+        Delete queues closed more than queue_ttl seconds ago, return the number of deleted queues and reclaimed bytes.
+        Queues matching the pattern that are neither open, closed nor in keep are adopted as closed now.
+        """
+        if self.client is None:
+            raise exception.NotConnected()
+
+        keep = keep or set()
+        now = time.time()
+
+        async for name in self.client.scan_iter(match=pattern):
+            name = name.decode()
+            if name in keep or self.check(name):
+                continue
+            await self.client.zadd(closed_key, {name: now}, nx=True)
+
+        names = [
+            name.decode()
+            for name in await self.client.zrangebyscore(closed_key, "-inf", now - utils.config.queue_ttl)
+        ]
+        names = [name for name in names if name not in keep and not self.check(name)]
+        if not names:
+            return 0, 0
+
+        reclaimed = 0
+        for name in names:
+            reclaimed += await self.client.memory_usage(name) or 0
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.unlink(*names)
+            pipe.zrem(closed_key, *names)
+            pipe.hdel(RedisStreamQueue.registry, *names)
+            await pipe.execute()
+
+        for name in names:
+            self.queues.pop(name, None)
+
+        return len(names), reclaimed
+
     async def stop(self):
         for queue in self.queues.values():
             await queue.close()
         await self.client.close()
         self.client = None
         self.queues.clear()
+
+
+class RedisStreamQueue(RedisQueue):
+    """
+    Queue backed by a Redis stream, listeners are fed by XREAD so they also see items put by other processes
+    """
+    registry: str = "justyse:streams"
+    owner: bool = True
+    last_id: str = "0-0"
+    reader: asyncio.Task = None
+
+    def __init__(self,
+                 client: redis.Redis,
+                 name: str,
+                 from_cache: bool = False,
+                 maxlen: int = None,
+                 owner: bool = True):
+        super().__init__(client, name, from_cache, maxlen)
+        self.owner = owner
+
+    def on(self, event: typing.Literal['put', 'close']):
+        warper_ = super().on(event)
+
+        def warper(func: typing.Callable):
+            id_ = warper_(func)
+            if not self.closed and self.reader is None:
+                self.reader = asyncio.create_task(self.read())
+            return id_
+
+        return warper
+
+    async def read(self):
+        while not self.closed and any(self.events.values()):
+            try:
+                response = await self.client.xread(
+                    {self.name: self.last_id},
+                    count=100,
+                    block=utils.config.recv_timeout * 1000
+                )
+            except asyncio.CancelledError:
+                break
+
+            except Exception as error:
+                logger.error(f"Read stream {self.name} raise exception, detail")
+                logger.exception(error)
+                break
+
+            for _, entries in response or []:
+                items = []
+                for entry_id, fields in entries:
+                    self.last_id = entry_id.decode()
+                    event = fields.get(b"event", b"put")
+                    if event == b"close":
+                        await super()._notify(items)
+                        self.reader = None
+                        return await self.shutdown()
+
+                    if event == b"put":
+                        items.append(fields[b"item"].decode())
+
+                await super()._notify(items)
+
+        self.reader = None
+
+    async def _write(self, pending: list[tuple[str, bool]]):
+        async with self.client.pipeline(transaction=False) as pipe:
+            for item, non_event in pending:
+                pipe.xadd(
+                    self.name,
+                    {"event": "none" if non_event else "put", "item": item},
+                    maxlen=self.maxlen or utils.config.stream_maxlen,
+                    approximate=True
+                )
+            pipe.hsetnx(self.registry, self.name, "open")
+            await pipe.execute()
+
+    async def _notify(self, items: list[str]):
+        # Listeners are fed by the reader
+        pass
+
+    async def entries(self, start: str = "-", end: str = "+", count: int = None):
+        return [
+            (entry_id.decode(), fields[b"item"].decode())
+            for entry_id, fields in await self.client.xrange(self.name, start, end, count)
+            if fields.get(b"event", b"put") != b"close"
+        ]
+
+    async def get(self):
+        await self.flush()
+        entries = await self.client.xrevrange(self.name, "+", "-", 2)
+        items = [fields[b"item"] for _, fields in entries if b"item" in fields]
+        if not items:
+            return None
+        try:
+            return json.loads(items[0])
+        except (TypeError, json.JSONDecodeError):
+            return items[0].decode()
+
+    async def get_all(self):
+        await self.flush()
+        entries = await self.entries()
+        if entries:
+            self.last_id = entries[-1][0]
+        items = [item for _, item in entries]
+        try:
+            items = [json.loads(item) for item in items]
+        except (TypeError, json.JSONDecodeError):
+            pass
+        return items
+
+    async def close(self, non_event: bool = False):
+        await self.flush()
+        if self.owner and not self.closed:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.xadd(self.name, {"event": "close"}, maxlen=self.maxlen or utils.config.stream_maxlen,
+                          approximate=True)
+                pipe.hset(self.registry, self.name, "closed")
+                pipe.zadd(closed_key, {self.name: time.time()})
+                await pipe.execute()
+
+        if self.reader is not None and not non_event:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.reader), timeout=utils.config.send_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+
+        if not self.closed:
+            await self.shutdown(non_event)
+
+    async def empty(self):
+        await self.flush()
+        return await self.client.xlen(self.name) == 0
+
+
+class StreamQueueManager(QueueManager):
+    """
+    Keep track of streams in Redis, so every API worker can find a judge queue
+    """
+
+    def create(self, name: str, maxlen: int = None):
+        if self.check(name):
+            raise exception.QueueAlreadyExist(name)
+        queue = RedisStreamQueue(self.client, name, maxlen=maxlen)
+        self.queues[name] = queue
+        return queue
+
+    def add(self, queue: RedisQueue, skip_check: bool = False):
+        if not isinstance(queue, RedisStreamQueue):
+            raise exception.QueueNotValid(type(queue))
+        super().add(queue, skip_check)
+
+    async def state(self, name: str) -> typing.Optional[str]:
+        if self.client is None:
+            raise exception.NotConnected()
+
+        state = await self.client.hget(RedisStreamQueue.registry, name)
+        return state.decode() if state is not None else None
+
+    async def exists(self, name: str):
+        return self.check(name) or await self.state(name) is not None
+
+    async def open(self, name: str) -> RedisStreamQueue:
+        if self.check(name):
+            return self.queues[name]
+
+        state = await self.state(name)
+        if state is None:
+            raise exception.QueueNotFound(name)
+
+        return RedisStreamQueue(self.client, name, from_cache=state == "closed", owner=False)
+
+    async def check_cache(self, name: str):
+        if self.client is None:
+            raise exception.NotConnected()
+        return await self.client.xlen(name) > 0
+
+    async def get_cache(self, name: str):
+        if not await self.check_cache(name):
+            raise exception.QueueNotFound(name)
+
+        return RedisStreamQueue(self.client, name, from_cache=True, owner=False)
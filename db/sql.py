@@ -2,6 +2,7 @@
 For mixing-stored type
 """
 import ast
+import datetime
 import os
 import typing
 import copy
@@ -15,7 +16,8 @@ from sqlmodel import create_engine, SQLModel, Session, select
 
 import declare
 import utils
-from declare import Language
+from declare import Language, Indexable
+from . import archive
 from .declare import (
     files_dir,
     submissions_dir,
@@ -78,6 +80,14 @@ class SQLSubmissionLog(SubmissionLog, table=True):
     pass
 
 
+class SQLSubmissionLogArchive(Indexable, table=True):
+    __tablename__ = "submission_log_archives"
+    id: str = sqlmodel.Field(default_factory=lambda: str(uuid.uuid4()), primary_key=True)
+    submission: str = sqlmodel.Field(foreign_key="submissions.id")
+    data: bytes = sqlmodel.Field(sa_column=sqlmodel.Column(sqlmodel.LargeBinary))
+    created_at: str = sqlmodel.Field(default_factory=lambda: str(datetime.datetime.now()))
+
+
 sql_engine: Engine = None
 
 
@@ -92,6 +102,24 @@ def setup():
         echo=os.getenv("ENV", "PROD") == "DEBUG"
     )
     SQLModel.metadata.create_all(sql_engine)
+    migrate()
+
+
+# Columns added after their table was first created, create_all leaves existing tables as they are
+migrations: list[tuple[type[SQLModel], str, str]] = [
+    (SQLProblems, "stop_on_first_failure", "BOOLEAN NOT NULL DEFAULT FALSE"),
+]
+
+
+def migrate():
+    inspector = sqlalchemy.inspect(sql_engine)
+    with sql_engine.begin() as connection:
+        for model, column, definition in migrations:
+            table = model.__tablename__
+            if not inspector.has_table(table) or \
+                    column in [existing["name"] for existing in inspector.get_columns(table)]:
+                continue
+            connection.execute(sqlalchemy.text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
 
 
 """
@@ -412,28 +440,57 @@ def update_submission(id: str, submission_: UpdateSubmissions):
 
 def get_log_ids(submission_id: str = None) -> typing.List[str]:
     with Session(sql_engine) as session:
+        statement = select(SQLSubmissionLogArchive.id).where(SQLSubmissionLogArchive.submission == submission_id)
+        archived = session.exec(statement).all()
         statement = select(SQLSubmissionLog.id).where(SQLSubmissionLog.submission == submission_id)
-        return session.exec(statement).all()
+        return archived + session.exec(statement).all()
 
 
-def dump_logs(submission_id: str, id: str, logs: list[str]):
+def dump_logs(submission_id: str, id: str, logs: list):
     submission = get_submission(submission_id)
-    if id in get_log_ids():
+    if id in get_log_ids(submission.id):
         raise SubmissionLogAlreadyExist(id)
 
-    log = SQLSubmissionLog(
+    log = SQLSubmissionLogArchive(
         id=id,
         submission=submission.id,
-        logs=logs
+        data=archive.encode(logs)
     )
     with Session(sql_engine) as session:
         session.add(log)
         session.commit()
 
 
-def get_logs(submission: id, id: str) -> list[str]:
+def iter_logs(submission: str, id: str) -> typing.Iterator[typing.Any]:
+    submission = get_submission(submission)
+    with Session(sql_engine) as session:
+        statement = select(SQLSubmissionLogArchive.data).where(
+            sqlmodel.and_(SQLSubmissionLogArchive.id == id,
+                          SQLSubmissionLogArchive.submission == submission.id)
+        )
+        data = session.exec(statement).first()
+    if data is not None:
+        return archive.iter_decode_bytes(data)
+
+    return iter(get_logs(submission.id, id).logs)
+
+
+def get_logs(submission: str, id: str) -> SubmissionLog:
     submission = get_submission(submission)
     with Session(sql_engine) as session:
+        statement = select(SQLSubmissionLogArchive).where(
+            sqlmodel.and_(SQLSubmissionLogArchive.id == id,
+                          SQLSubmissionLogArchive.submission == submission.id)
+        )
+        archived = session.exec(statement).first()
+        if archived:
+            return SubmissionLog(
+                id=archived.id,
+                submission=archived.submission,
+                logs=archive.decode(archived.data),
+                created_at=archived.created_at
+            )
+
         statement = select(SQLSubmissionLog).where(
             sqlmodel.and_(SQLSubmissionLog.id == id,
                           SQLSubmissionLog.submission == submission.id)
@@ -444,6 +501,37 @@ def get_logs(submission: id, id: str) -> list[str]:
         return log
 
 
+convert_batch_size: int = 500
+
+
+def convert_logs() -> int:
+    """
+    Move logs stored as JSON to the archive table, return the number of converted logs.
+    Logs are converted and committed in batches, so a large table is never loaded at once.
+    """
+    converted, last = 0, ""
+    while True:
+        with Session(sql_engine) as session:
+            statement = select(SQLSubmissionLog).where(SQLSubmissionLog.id > last) \
+                .order_by(SQLSubmissionLog.id).limit(convert_batch_size)
+            logs = session.exec(statement).all()
+            if len(logs) == 0:
+                return converted
+
+            for log in logs:
+                session.add(SQLSubmissionLogArchive(
+                    id=log.id,
+                    submission=log.submission,
+                    data=archive.encode(log.logs),
+                    created_at=log.created_at
+                ))
+                session.delete(log)
+
+            last = logs[-1].id
+            session.commit()
+            converted += len(logs)
+
+
 """
 User
 """
@@ -1,13 +1,31 @@
-from . import client, manager, exception, data
+from . import client, manager, exception, data, queue, cost, rejudge, verdict, leader, frame
 from .manager import JudgeManager
 from .client import JudgeClient
+from .leader import Leader
+from .queue import Job, JudgeQueue, Priority
+from .rejudge import Rejudge, RejudgeFilter, RejudgeProgress, RejudgeRecord, RejudgeStore
 
 __all__ = [
     "client",
     "manager",
     "exception",
     "data",
+    "queue",
+    "cost",
+    "rejudge",
+    "verdict",
+    "leader",
+    "frame",
     "JudgeManager",
     "JudgeClient",
+    "Leader",
+    "Job",
+    "JudgeQueue",
+    "Priority",
+    "Rejudge",
+    "RejudgeFilter",
+    "RejudgeProgress",
+    "RejudgeRecord",
+    "RejudgeStore",
 ]
 
@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import json
 import logging
 import os
@@ -13,7 +14,7 @@ import websockets
 import db
 import declare
 import utils
-from . import exception
+from . import exception, frame
 
 
 # import websockets.sync.client as ws_sync
@@ -25,6 +26,8 @@ class JudgeClient:
     uri: str
     id: str
     name: str
+    server: str
+    slot: int
     _ws: websockets.WebSocketClientProtocol = None
     # _recv_timeout: int
     is_closed: bool = False
@@ -32,13 +35,25 @@ class JudgeClient:
     # _thread_manager: utils.ThreadingManager
 
     _debug: typing.List[typing.Any] = []
-    _status_msg: asyncio.Queue
+    _status: dict
+    _status_at: float = 0
+    _status_event: asyncio.Event
     _judge_msg: asyncio.Queue
     _other_msg: asyncio.Queue
 
     is_judging: bool = False
-    stop_judge: asyncio.Event = asyncio.Event()
-    stop_recv: asyncio.Event = asyncio.Event()
+    # Whether the server keeps testcases by content hash, None until asked
+    content_addressed: bool | None = None
+    # Whether the server takes a whole testset in one command.testcases, None until asked
+    bulk_testcases: bool | None = None
+    # Protocol extensions the server announced, empty for servers that do not answer command.capabilities
+    capabilities: set[str] = set()
+    # Capabilities and slots of every judge server, asked once for all its sessions and reconnects
+    known: dict[str, tuple[set[str], int | None]] = {}
+    # Submissions the server judges at once, None when it does not tell
+    slots: int | None = None
+    stop_judge: asyncio.Event
+    stop_recv: asyncio.Event
 
     recv_task: asyncio.Task = None
     heartbeat_task: asyncio.Task = None
@@ -48,20 +63,29 @@ class JudgeClient:
     def __init__(self,
                  uri: str,
                  id: str,
-                 name: str,):
+                 name: str,
+                 server: str = None,
+                 slot: int = 0):
         self.uri = uri
         self.id = id
         self.name = name
+        self.server = server if server is not None else id
+        self.slot = slot
         # self._recv_timeout = recv_timeout
         # self._thread_manager = thread_manager
         self.is_closed = False
 
         self._debug = []
-        self._status_msg = asyncio.Queue()
+        self._status = {"status": "idle"}
+        self._status_event = asyncio.Event()
         self._judge_msg = asyncio.Queue()
         self._other_msg = asyncio.Queue()
 
         self.is_judging = False
+        self.capabilities = set()
+        self.slots = None
+        self.stop_judge = asyncio.Event()
+        self.stop_recv = asyncio.Event()
 
         self._logger = logging.getLogger(f"justyse.judge.{id}")
         self._logger.addHandler(utils.console_handler(f"Judge server#{self.id}"))
@@ -70,7 +94,8 @@ class JudgeClient:
         if self.is_judging is True:
             raise exception.ServerBusy()
 
-        self._ws = await websockets.connect(self.uri)
+        # permessage-deflate, used when the server accepts it
+        self._ws = await websockets.connect(self.uri, compression="deflate")
         fut = await self._ws.ping()
         await fut
 
@@ -81,19 +106,26 @@ class JudgeClient:
         # self._logger.debug(f"Connected to {self.name} server#{self._id}")
 
         self.is_closed = False
+        self.content_addressed = None
+        self.bulk_testcases = None
+        self.capabilities = set()
+        self.slots = None
         self.stop_judge.clear()
         self.stop_recv.clear()
         self.recv_task = asyncio.create_task(self.recv())
         self.heartbeat_task = asyncio.create_task(self.ping())
 
+        await self.refresh_status()
+        await self._capabilities()
+
     async def close(self):
         if self.is_closed:
             return
         self.is_closed = True
         self.stop_recv.set()
         await self._judge_msg.put(['closed'])
-        await self._status_msg.put(['closed'])
         await self._other_msg.put(['closed'])
+        self._update_status({"status": "closed"})
 
         if self.is_judging:
             self.stop_judge.set()
@@ -198,9 +230,13 @@ class JudgeClient:
                     continue
 
                 if msg[0] == 'status':
-                    await self._status_msg.put(msg)
+                    self._update_status(dict(declare.Status(**msg[1])))
 
                 elif msg[0].startswith("judge."):
+                    if msg[0] == 'judge.init':
+                        self._update_status({**self._status, "status": "busy"})
+                    elif msg[0] in ['judge.done', 'judge.aborted']:
+                        self._update_status({**self._status, "status": "idle"})
                     await self._judge_msg.put(msg)
 
                 else:
@@ -230,24 +266,105 @@ class JudgeClient:
             self._logger.exception(e)
             return self.close()
 
+    @property
+    def is_paused(self) -> bool:
+        return self._pause
+
     async def pause(self):
         self._pause = True
 
     async def resume(self):
         self._pause = False
 
-    async def status(self) -> declare.Status:
+    def _update_status(self, status: dict):
+        self._status = status
+        self._status_at = time.time()
+        self._status_event.set()
+        self._status_event.clear()
+
+    @property
+    def status_age(self) -> float:
+        """
+        Seconds since the cached status was last updated
+        """
+        return time.time() - self._status_at
+
+    def status(self) -> dict:
+        """
+        Cached status, kept up to date by server pushes and session lifecycle messages
+        """
         if self.is_closed:
             return {"status": "closed"}
         if self._pause:
             return {"status": "paused"}
+        if self.is_judging:
+            return {**self._status, "status": "busy"}
+        return self._status
 
+    async def refresh_status(self) -> dict:
+        """
+        Ask the server for its status, concurrent callers wait for the same reply
+        """
+        if self.is_closed:
+            return self.status()
+
+        waiter = asyncio.create_task(self._status_event.wait())
         await self._send(["command.status"])
-        response = await self._status_msg.get()
-        if response[0] == 'closed':
-            return {"status": "closed"}
+        try:
+            await asyncio.wait_for(waiter, timeout=utils.config.recv_timeout)
+        except asyncio.TimeoutError:
+            self._logger.debug("Status request timeout")
+        return self.status()
+
+    async def _capabilities(self):
+        """
+        Ask which protocol extensions the server has, once per server, the ones it lists need no probing.
+        The reply is the list of extensions, or {"extensions": [...], "slots": n} from servers that tell their slots.
+        """
+        if self.server not in self.known:
+            await self._send(["command.capabilities", None])
 
-        return declare.Status(**response[1])
+            deadline = time.monotonic() + utils.config.capabilities_timeout
+            try:
+                while True:
+                    response = await asyncio.wait_for(self._other_msg.get(), deadline - time.monotonic())
+                    if response[0] == 'closed':
+                        return
+                    if response[0] == 'capabilities':
+                        break
+
+                reply = response[1] or []
+                slots = None
+                if isinstance(reply, dict):
+                    slots = reply.get("slots")
+                    slots = slots if isinstance(slots, int) and slots >= 1 else None
+                    reply = reply.get("extensions") or []
+                self.known[self.server] = (set(reply), slots)
+
+            except asyncio.TimeoutError:
+                self._logger.debug("Judge server has no protocol extensions")
+                self.known[self.server] = (set(), None)
+
+        self.capabilities, self.slots = self.known[self.server]
+        self.content_addressed = "testcases:announce" in self.capabilities
+        self.bulk_testcases = "testcases" in self.capabilities
+
+    @classmethod
+    def forget(cls, server: str):
+        """
+        Ask the server for its capabilities again on its next connect, such as after an upgrade
+        """
+        cls.known.pop(server, None)
+
+    @property
+    def binary_frames(self) -> bool:
+        return "frames" in self.capabilities
+
+    def _compress_threshold(self) -> int:
+        # Frames are not compressed twice when permessage-deflate already compresses every message
+        if self._ws is not None and len(self._ws.extensions) > 0:
+            return 0
+        return utils.config.compress_threshold
 
     async def _init(self,
                     submission: db.Submissions,
@@ -288,27 +405,183 @@ class JudgeClient:
 
         return self._debug.append("written:code")
 
-    async def _testcases(self, problem: db.DBProblems, test_range: typing.Tuple[int, int]):
+    async def _announce(self, problem: db.DBProblems, test_range: typing.Tuple[int, int]) -> set[int] | None:
+        """
+        Announce the content hashes of the testcases, return the indexes the server is missing,
+        None when every testcase has to be sent
+        """
+        if not self.content_addressed:
+            return None
+
+        # Built at upload, only problems uploaded before manifests existed are hashed here
+        manifest = await asyncio.to_thread(db.manifest.get, problem)
+        tests = [
+            [i, *manifest[str(i)]]
+            for i in range(test_range[0], test_range[1] + 1)
+            if str(i) in manifest
+        ]
+        if len(tests) != test_range[1] - test_range[0] + 1:
+            return None
+
+        await self._send(["command.testcases:announce", tests])
+
+        try:
+            response = await asyncio.wait_for(self._judge_msg.get(), utils.config.recv_timeout)
+        except asyncio.TimeoutError:
+            response = None
+
+        if response is not None and response[0] == 'closed':
+            await self._judge_msg.put(response)
+            return None
+
+        if response is None or response[0] != 'judge.testcases:missing':
+            self._logger.info("Judge server does not keep testcases by content, sending all of them")
+            self.content_addressed = False
+            return None
+
+        if response[1].get("status") != 0:
+            raise exception.TestcaseWriteError(response[1].get("error", None))
+
+        self.content_addressed = True
+        missing = set(response[1].get("missing", []))
+        return {i for i, input_hash, output_hash in tests if input_hash in missing or output_hash in missing}
+
+    def _read_testcase(self, problem: db.DBProblems, i: int) -> list:
+        test_dir = os.path.join(problem.dir, "testcases", str(i))
+        input_content = utils.read(os.path.join(test_dir, problem.test_name[0]))
+        output_content = utils.read(os.path.join(test_dir, problem.test_name[1]))
+
+        if not input_content and not output_content:
+            self._logger.warning(f"input file or output file of test {i} is empty")
+
+        return [i, input_content, output_content]
+
+    def _read_testcase_bytes(self, problem: db.DBProblems, i: int) -> list[bytes]:
+        test_dir = os.path.join(problem.dir, "testcases", str(i))
+        contents = []
+        for name in problem.test_name[:2]:
+            path = os.path.join(test_dir, name)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    contents.append(f.read())
+            else:
+                contents.append(b"")
+
+        if not any(contents):
+            self._logger.warning(f"input file or output file of test {i} is empty")
+
+        return contents
+
+    def _testcase_message(self, problem: db.DBProblems, command: str, indexes: list[int]) -> list | bytes:
+        """
+        command.testcase of one index or command.testcases of many, as a binary frame when the server takes them
+        """
+        if self.binary_frames:
+            return frame.encode(
+                command,
+                indexes,
+                [content for i in indexes for content in self._read_testcase_bytes(problem, i)],
+                self._compress_threshold()
+            )
+
+        tests = [self._read_testcase(problem, i) for i in indexes]
+        return [command, tests[0] if command == "command.testcase" else tests]
+
+    async def _testcases_bulk(self, problem: db.DBProblems, indexes: list[int]) -> bool:
+        """
+        Send a small testset in one message, False when it has to be sent testcase by testcase
+        """
+        if not self.bulk_testcases:
+            return False
+
         test_dir = os.path.join(problem.dir, "testcases")
-        for i in range(test_range[0], test_range[1] + 1):
-            input_file = os.path.join(test_dir, str(i), problem.test_name[0])
-            output_file = os.path.join(test_dir, str(i), problem.test_name[1])
-            input_content = utils.read(input_file)
-            output_content = utils.read(output_file)
+        try:
+            size = sum(os.path.getsize(os.path.join(test_dir, str(i), name))
+                       for i in indexes for name in problem.test_name[:2])
+        except OSError:
+            return False
+        if size > utils.config.testcase_bulk_size:
+            return False
+
+        await self._send(self._testcase_message(problem, "command.testcases", indexes))
+
+        try:
+            response = await asyncio.wait_for(self._judge_msg.get(), utils.config.recv_timeout)
+        except asyncio.TimeoutError:
+            response = None
+
+        if response is not None and response[0] == 'closed':
+            await self._judge_msg.put(response)
+            raise exception.TestcaseWriteError("Judge server closed the connection")
+
+        if response is None or response[0] != 'judge.write:testcases':
+            self._logger.info("Judge server does not take testcases in bulk, sending them one by one")
+            self.bulk_testcases = False
+            return False
+
+        if response[1].get("status") != 0:
+            raise exception.TestcaseWriteError(response[1].get("error", None))
+
+        self.bulk_testcases = True
+        self._debug.append(f"written:testcases {len(indexes)}")
+        return True
+
+    async def _testcases_window(self, problem: db.DBProblems, indexes: list[int]):
+        """
+        Keep up to testcase_window testcases in flight, acks are matched by index.
+        Nothing more is sent after the first failed write, each ack is waited for up to recv_timeout seconds.
+        """
+        pending = collections.deque(indexes)
+        in_flight = collections.deque()
+        error = None
+
+        while len(in_flight) > 0 or (error is None and len(pending) > 0):
+            while error is None and len(pending) > 0 and len(in_flight) < max(1, utils.config.testcase_window):
+                i = pending.popleft()
+                await self._send(self._testcase_message(problem, "command.testcase", [i]))
+                in_flight.append(i)
+
+            try:
+                response = await asyncio.wait_for(self._judge_msg.get(), utils.config.recv_timeout)
+            except asyncio.TimeoutError:
+                raise error or exception.TestcaseWriteError(f"Judge server did not ack testcase {in_flight[0]}")
+
+            if response[0] == 'closed':
+                await self._judge_msg.put(response)
+                raise error or exception.TestcaseWriteError("Judge server closed the connection")
+
+            if response[0] != 'judge.write:testcase':
+                # Such as judge.error:system, the server gave up on the upload
+                detail = response[1] if len(response) > 1 and isinstance(response[1], dict) else {}
+                # Acks already queued belong to this upload, not to the next session
+                while not self._judge_msg.empty():
+                    self._judge_msg.get_nowait()
+                raise error or exception.TestcaseWriteError(detail.get("error", response[0]))
 
-            if not input_content and not output_content:
-                self._logger.warning(f"input file or output file of test {i} is empty")
+            # Servers that do not tell the index ack in order
+            i = response[1].get("index")
+            if i not in in_flight:
+                i = in_flight[0]
+            in_flight.remove(i)
 
-            await self._send(["command.testcase", [i, input_content, output_content]])
+            if response[1].get("status") != 0 and error is None:
+                error = exception.TestcaseWriteError(response[1].get("error", None))
 
-            response = await self._judge_msg.get()
-            if response[0] == 'judge.write:testcase':
-                if response[1].get("status") != 0:
-                    raise exception.TestcaseWriteError(response[1].get("error", None))
-                # if response[1].get("index") != i:
-                #     raise exception.TestcaseMismatchError(f"Expect {i}, got {response[1].get('index')}")
+            if error is None:
+                self._debug.append(f"written:testcase {i}")
 
-            self._debug.append(f"written:testcase {i}")
+        if error is not None:
+            raise error
+
+    async def _testcases(self, problem: db.DBProblems, test_range: typing.Tuple[int, int]):
+        missing = await self._announce(problem, test_range)
+        if missing is not None:
+            self._debug.append(f"cached:testcase {test_range[1] - test_range[0] + 1 - len(missing)}")
+
+        indexes = [i for i in range(test_range[0], test_range[1] + 1) if missing is None or i in missing]
+        if len(indexes) == 0 or await self._testcases_bulk(problem, indexes):
+            return
+        await self._testcases_window(problem, indexes)
 
     async def _judger(self, problem: db.DBProblems):
         if not os.path.exists(os.path.join(problem.dir, "judger.py")):
@@ -340,11 +613,6 @@ class JudgeClient:
                          # abort: asyncio.Event,
                          skip_debug: bool = True) -> typing.AsyncIterable[tuple[str, str | dict]]:
 
-        status = await self.status()
-        status = status["status"]
-        if status == "busy":
-            exception.ServerBusy()
-
         if self.stop_judge.is_set():
             return
 
@@ -352,6 +620,43 @@ class JudgeClient:
         self.is_judging = True
         self._debug = []
 
+        try:
+            async for status, data in self._judge_iter(submission, problem, test_range, skip_debug):
+                yield status, data
+
+        finally:
+            self.is_judging = False
+            self._status_at = time.time()
+            if not self.is_closed:
+                self.stop_judge.clear()
+
+    def abort(self):
+        """
+        Stop the running session, judge_iter yields 'abort' once the server confirmed it
+        """
+        if self.is_judging:
+            self.stop_judge.set()
+
+    async def _drain(self):
+        """
+        Drop the messages of an aborted session, so they do not leak into the next one
+        """
+        try:
+            while True:
+                response = await asyncio.wait_for(self._judge_msg.get(), utils.config.recv_timeout)
+                if response[0] in ['closed', 'judge.aborted', 'judge.done']:
+                    break
+        except asyncio.TimeoutError:
+            self._logger.warning("Judge server did not confirm the abort")
+
+        while not self._judge_msg.empty():
+            self._judge_msg.get_nowait()
+
+    async def _judge_iter(self,
+                          submission: db.Submissions,
+                          problem: db.Problems,
+                          test_range: typing.Tuple[int, int],
+                          skip_debug: bool = True) -> typing.AsyncIterable[tuple[str, str | dict]]:
         yield 'initting', None
         await self._send(['command.start', None])
         await self._init(submission=submission, problem=problem, test_range=test_range)
@@ -366,6 +671,8 @@ class JudgeClient:
         while True:
             if self.stop_judge.is_set():
                 await self._send(['command.abort'])
+                if not self.is_closed:
+                    await self._drain()
                 yield 'abort', None
                 return
 
@@ -412,6 +719,5 @@ class JudgeClient:
                     if skip_debug is False:
                         yield 'debug', response
 
-        self.is_judging = False
         yield 'done', None
         return
@@ -0,0 +1,91 @@
+"""
+Per-testcase runtime history, used to balance tests across judge servers
+"""
+
+import os
+
+import db
+import utils
+
+runtime_name = "runtime.json"
+
+
+def runtime_file(problem: db.DBProblems) -> str:
+    # Next to the testcases, so replacing the testcases also drops their history
+    return os.path.join(problem.dir, "testcases", runtime_name)
+
+
+def get_runtimes(problem: db.DBProblems) -> dict[int, float]:
+    file = runtime_file(problem)
+    if not os.path.exists(file):
+        return {}
+
+    try:
+        return {int(index): float(runtime) for index, runtime in utils.read_json(file).items()}
+    except (ValueError, TypeError, AttributeError):
+        return {}
+
+
+def record(problem: db.DBProblems, runtimes: dict[int, float]):
+    """
+    Merge measured runtimes into the history, as a moving average per testcase
+    """
+    runtimes = {index: runtime for index, runtime in runtimes.items() if runtime is not None and runtime >= 0}
+    if len(runtimes) == 0 or not os.path.exists(os.path.dirname(runtime_file(problem))):
+        return
+
+    history = get_runtimes(problem)
+    for index, runtime in runtimes.items():
+        history[index] = runtime if index not in history else history[index] * 0.7 + runtime * 0.3
+
+    utils.write_json(runtime_file(problem), {str(index): runtime for index, runtime in sorted(history.items())})
+
+
+def estimate(problem: db.DBProblems) -> list[float]:
+    """
+    Estimated cost of every testcase, index 0 is testcase 1.
+    Tests without history are estimated from their input size, scaled by the tests that have both.
+    """
+    history = get_runtimes(problem)
+    test_dir = os.path.join(problem.dir, "testcases")
+
+    sizes = {}
+    for index in range(1, problem.total_testcases + 1):
+        if index in history:
+            continue
+        try:
+            sizes[index] = os.path.getsize(os.path.join(test_dir, str(index), problem.test_name[0]))
+        except OSError:
+            sizes[index] = 0
+
+    scale = 1.0
+    if len(sizes) > 0 and len(history) > 0:
+        known = [
+            (runtime, os.path.getsize(os.path.join(test_dir, str(index), problem.test_name[0])))
+            for index, runtime in history.items()
+            if os.path.exists(os.path.join(test_dir, str(index), problem.test_name[0]))
+        ]
+        total_size = sum(size for _, size in known)
+        if total_size > 0:
+            scale = sum(runtime for runtime, _ in known) / total_size
+
+    costs = [
+        history[index] if index in history else sizes[index] * scale
+        for index in range(1, problem.total_testcases + 1)
+    ]
+
+    # Empty inputs still cost a process start
+    floor = min([cost for cost in costs if cost > 0], default=1)
+    return [max(cost, floor) for cost in costs]
+
+
+def time_limit(problem: db.DBProblems) -> float:
+    """
+    Time limit of one test in seconds
+    """
+    limit = problem.limit
+    value = limit.get("time") if isinstance(limit, dict) else getattr(limit, "time", None)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return utils.config.judge_default_test_time
@@ -1,5 +1,7 @@
 import os
 
+import pydantic
+
 import db
 import declare
 import utils
@@ -10,6 +12,8 @@ class Server(declare.PydanticIndexable):
     uri: str
     name: str
     id: str | None
+    # Submissions the server can judge at once, one session each, for servers that do not advertise it
+    slots: int = pydantic.Field(default=1, ge=1)
 
 
 server_json = os.path.join(db.declare.data, "servers.json")
@@ -56,3 +56,11 @@ class ConnectionError(InitalizationError):
 
 class ServerNotFound(NotFound):
     pass
+
+
+class RejudgeRunning(ValueError):
+    pass
+
+
+class RejudgeNotFound(NotFound):
+    pass
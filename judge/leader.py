@@ -0,0 +1,102 @@
+"""
+Election of the one API worker that dispatches judge jobs, through a Redis lock renewed while the worker lives
+"""
+
+import asyncio
+import logging
+import uuid
+
+import redis.asyncio as redis
+
+import utils
+
+logger: logging.Logger = logging.getLogger("justyse.judge.leader")
+logger.addHandler(utils.console_handler("Leader"))
+
+# Only touch the lock while it still holds our token
+renew_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+release_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class Leader:
+    """
+    The lock expires after `lease` seconds and is renewed every third of it,
+    so another worker takes over within about one lease after the leader dies
+    """
+    key: str = "judge:leader"
+
+    client: redis.Redis
+    token: str
+    lease: float
+    is_leader: bool
+    elected: asyncio.Event
+    deposed: asyncio.Event
+
+    def __init__(self, client: redis.Redis, lease: float = None):
+        self.client = client
+        self.token = uuid.uuid4().hex
+        self.lease = lease or utils.config.judge_leader_lease
+        self.is_leader = False
+        self.elected = asyncio.Event()
+        self.deposed = asyncio.Event()
+        self.deposed.set()
+
+    async def acquire(self) -> bool:
+        return bool(await self.client.set(self.key, self.token, nx=True, px=int(self.lease * 1000)))
+
+    async def renew(self) -> bool:
+        return bool(await self.client.eval(renew_script, 1, self.key, self.token, int(self.lease * 1000)))
+
+    async def release(self):
+        try:
+            await self.client.eval(release_script, 1, self.key, self.token)
+        finally:
+            self._depose()
+
+    def _elect(self):
+        self.is_leader = True
+        self.deposed.clear()
+        self.elected.set()
+
+    def _depose(self):
+        self.is_leader = False
+        self.elected.clear()
+        self.deposed.set()
+
+    async def campaign(self):
+        """
+        Try to take the lock until elected, then keep renewing it
+        """
+        while True:
+            try:
+                held = await (self.renew() if self.is_leader else self.acquire())
+
+            except asyncio.CancelledError:
+                break
+
+            except Exception as error:
+                # Without Redis the lock may expire unnoticed, so stop leading
+                logger.error("Election raise exception, detail")
+                logger.exception(error)
+                held = False
+
+            if held and not self.is_leader:
+                logger.info("Elected as judge dispatcher")
+                self._elect()
+
+            elif not held and self.is_leader:
+                logger.warning("Lost the judge dispatcher lock")
+                self._depose()
+
+            await asyncio.sleep(self.lease / 3)
@@ -1,4 +1,6 @@
 import asyncio
+import collections
+import json
 import logging
 # import threading
 import typing
@@ -9,21 +11,46 @@ import db
 import declare
 import utils
 from db.redis import RedisQueue
-from . import exception, data
+from . import exception, data, cost, verdict
 from .client import JudgeClient
+from .queue import Job, JudgeQueue, Priority
+from .rejudge import Rejudge, RejudgeProgress, RejudgeRecord, RejudgeStore
+from .verdict import Verdict, VerdictCache
 
 
 class JudgeManager:
+    status_key: str = "judge:status"
+    commands_key: str = "judge:commands"
+    # Commands a worker hands to the elected dispatcher, which owns the connections
+    forwarded: set[str] = {"add_server", "remove_server", "pause", "resume", "disconnect", "connect_with_id"}
+
+    # Only the elected worker dispatches, the others enqueue through Redis
+    coordinated: bool
+    leading: bool
+    # Set once the worker shuts down, progress is no longer delivered
+    closing: bool
+
     _logger: logging.Logger
-    _connections: typing.Dict[int, JudgeClient] = {}
+    _connections: typing.Dict[str, JudgeClient] = {}
+    _servers: dict[str, data.Server]
+    _speed: dict[str, float]
     # _thread_manager: utils.ThreadingManager
 
-    _judge_queue: asyncio.Queue = asyncio.Queue()
+    _judge_queue: JudgeQueue
+    _messages: dict[str, RedisQueue]
+    _capacity: asyncio.Condition
+    _busy: set[str]
+    # Enqueueing tasks of the rejudges started on this worker
+    _rejudges: dict[str, asyncio.Task]
+    _rejudge_store: RejudgeStore
+    _verdicts: VerdictCache
     # _judge_abort: dict[str, asyncio.Event] = {}
     # _timers: list[threading.Thread] = []
     # _judge_threads: list[threading.Thread] = []
     # _heartbeat_thread: threading.Thread = None
     _judge_tasks: list[asyncio.Task] = []
+    # Cached verdicts being replayed, on any worker, each removed once done
+    _replays: set[asyncio.Task]
     _reconnect_tasks: list[asyncio.Task] = []
 
     _reconnect_timeout: int = utils.config.reconnect_timeout
@@ -50,32 +77,229 @@ class JudgeManager:
         if max_retry is not None:
             self._max_retry = max_retry
 
+        self.coordinated = utils.config.judge_coordinator and db.redis_client is not None and \
+            utils.config.queue_backend == "stream"
+        self.leading = not self.coordinated
+        self.closing = False
+
+        self._judge_queue = JudgeQueue(db.redis_client, self.coordinated)
+        self._messages = {}
+        self._capacity = asyncio.Condition()
+        self._busy = set()
+        self._rejudges = {}
+        self._replays = set()
+        self._rejudge_store = RejudgeStore(db.redis_client)
+        self._verdicts = VerdictCache(db.redis_client)
+        self._servers = {}
+        self._speed = {}
+
         self._logger = logging.getLogger("justyse.judge.manager")
         self._logger.addHandler(utils.console_handler("Judge Manager"))
 
+        if utils.config.judge_coordinator and not self.coordinated:
+            # Progress of a job judged by another worker only reaches listeners through a stream
+            self._logger.warning("Coordinator mode needs Redis and the stream queue backend, "
+                                 "this worker dispatches its own submissions")
+
     def _get_connections(self):
         return {key: value for key, value in self._connections.items() if value is not None}
 
-    async def connect_with_id(self, id: int):
-        server = data.get_server(id)
-        return await self.connect(
-            uri=server.uri,
-            id=server.id,
-            name=server.name,
-            # where="connect_with_id"
+    def _free_connections(self) -> list[str]:
+        return [
+            key for key, client in self._get_connections().items()
+            if key not in self._busy and not client.is_closed and not client.is_paused and not client.is_judging
+        ]
+
+    async def _wake(self):
+        """
+        Tell the loop that judge servers may have become available
+        """
+        async with self._capacity:
+            self._capacity.notify_all()
+
+    async def _wait_for(self, predicate: typing.Callable[[], bool]):
+        async with self._capacity:
+            await self._capacity.wait_for(lambda: self.stop.is_set() or predicate())
+
+    def _sessions(self, id: str) -> dict[str, JudgeClient]:
+        """
+        Session clients of a judge server, keyed by session key
+        """
+        return {key: client for key, client in self._get_connections().items() if client.server == id}
+
+    def _in_flight(self, id: str) -> int:
+        return sum(1 for key in self._busy if key in self._connections and self._connections[key].server == id)
+
+    def _load(self, key: str) -> tuple[float, float]:
+        """
+        Sort key of a free session: the load of its server first, then its seconds per testcase
+        """
+        server = self._connections[key].server
+        return self._in_flight(server) / self._slots(server), self._speed.get(server, 0)
+
+    def _record_speed(self, id: str, elapsed: float, tests: int):
+        if tests <= 0 or elapsed <= 0:
+            return
+        speed = elapsed / tests
+        # Moving average, so one slow submission does not push a server out of rotation
+        self._speed[id] = speed if id not in self._speed else self._speed[id] * 0.8 + speed * 0.2
+
+    def has_server(self, id: str) -> bool:
+        return id in self._servers if self.leading else id in data.get_keys()
+
+    async def _forward(self, command: str, *args) -> bool:
+        """
+        Hand a server command to the elected dispatcher, True when this worker is not it
+        """
+        if self.leading:
+            return False
+        await db.redis_client.rpush(self.commands_key, json.dumps([command, *args]))
+        return True
+
+    async def commands(self):
+        """
+        Run server commands forwarded by the other workers
+        """
+        while not self.stop.is_set():
+            try:
+                item = await db.redis_client.blpop([self.commands_key], timeout=1)
+                if item is None:
+                    continue
+
+                command, *args = json.loads(item[1])
+                if command not in self.forwarded:
+                    self._logger.warning(f"Unknown forwarded command {command}, skipped")
+                    continue
+                if command == "add_server":
+                    args = [data.Server(**args[0])]
+                await getattr(self, command)(*args)
+
+            except asyncio.CancelledError:
+                break
+
+            except Exception as error:
+                self._logger.error("Forwarded command raise exception, detail")
+                self._logger.exception(error)
+
+    async def pump(self):
+        """
+        Move jobs enqueued by every worker into the local queue
+        """
+        while not self.stop.is_set():
+            try:
+                await self._judge_queue.receive()
+
+            except asyncio.CancelledError:
+                break
+
+            except Exception as error:
+                self._logger.error("Pump raise exception, detail")
+                self._logger.exception(error)
+                await asyncio.sleep(1)
+
+    def reset(self):
+        """
+        Forget the dispatch state once another worker took over, the jobs stay in Redis
+        """
+        for msg in self._messages.values():
+            # The next dispatcher keeps writing to the same judge queues
+            db.queue_manager.release(msg.name)
+        self._messages.clear()
+        self._judge_queue.reset()
+        self._busy.clear()
+        self._retry.clear()
+        self._servers.clear()
+
+    async def retire(self):
+        """
+        Hand the jobs left in Redis to the other processes right away, instead of once the heartbeat expires
+        """
+        await self._judge_queue.retire()
+
+    async def _snapshot(self) -> dict:
+        """
+        Dispatch state published by the elected worker, empty when there is none
+        """
+        raw = await db.redis_client.get(self.status_key)
+        return json.loads(raw) if raw is not None else {}
+
+    async def _publish(self):
+        await db.redis_client.set(
+            self.status_key,
+            json.dumps({
+                "queue": self._queue_status(),
+                "admission": self._admission(),
+                "users": self._queue_users(),
+                "servers": self._server_list()
+            }),
+            ex=utils.config.heartbeat_interval * 3
         )
 
+    @staticmethod
+    def session_key(server: data.Server, slot: int) -> str:
+        return server.id if slot == 0 else f"{server.id}:{slot}"
+
+    async def _connect_slot(self, server: data.Server, slot: int, retry: bool = False):
+        key = self.session_key(server, slot)
+        client = await self.connect(uri=server.uri,
+                                    id=key,
+                                    name=server.name,
+                                    server=server.id,
+                                    slot=slot,
+                                    retry=retry)
+        if client is not None or key not in self._connections:
+            self._connections[key] = client
+        await self._wake()
+        return client
+
+    def _slots(self, id: str) -> int:
+        """
+        Slots the server advertised on its first session, else the ones set in servers.json
+        """
+        client = self._connections.get(id)
+        if client is not None and client.slots is not None:
+            return client.slots
+        return self._servers[id].slots if id in self._servers else 1
+
+    async def _connect_server(self, server: data.Server, retry: bool = False) -> list[JudgeClient]:
+        """
+        Open the first session, which tells how many slots the server has, then the sessions of the others
+        """
+        def closed(slot: int) -> bool:
+            client = self._connections.get(self.session_key(server, slot))
+            return client is None or client.is_closed
+
+        if closed(0):
+            await self._connect_slot(server, 0, retry)
+
+        await asyncio.gather(*[
+            self._connect_slot(server, slot, retry) for slot in range(1, self._slots(server.id)) if closed(slot)
+        ])
+        return [client for client in self._sessions(server.id).values() if not client.is_closed]
+
+    async def connect_with_id(self, id: str):
+        if await self._forward("connect_with_id", id):
+            return []
+
+        server = data.get_server(id)
+        self._servers[id] = server
+        # Connected by hand, the server may have been upgraded
+        JudgeClient.forget(id)
+        return await self._connect_server(server)
+
     async def connect(self,
                       client: JudgeClient = None,
                       uri: str = None,
                       id: str = None,
                       name: str = None,
+                      server: str = None,
+                      slot: int = 0,
                       retry: bool = False,
                       # where: str = None
                       ):
-        if uri is not None and uri in [connection.uri for _, connection in self._connections.items()
-                                       if connection is not None]:
-            return self._logger.error(f"Already connected to Judge server: {uri}")
+        if uri is not None and id in self._connections and \
+                self._connections[id] is not None and not self._connections[id].is_closed:
+            return self._logger.error(f"Already connected to Judge server#{id}: {uri}")
 
         if client is None and (uri is None or id is None or name is None):
             raise ValueError("Invalid arguments")
@@ -102,6 +326,8 @@ class JudgeManager:
                     uri=f"{uri}/session" if not uri.endswith('/session') else uri,
                     id=id,
                     name=name,
+                    server=server,
+                    slot=slot,
                     # thread_manager=self._thread_manager,
                 )
                 await client.connect()
@@ -138,36 +364,42 @@ class JudgeManager:
                 self._logger.exception(error)
                 return None
 
-    async def disconnect(self, id):
-        if id not in self._connections:
-            raise exception.ServerNotFound(id)
+    async def _disconnect_session(self, key: str):
+        client = self._connections.pop(key, None)
+        self._retry[key] = -1
+
+        if client is None:
+            return
 
         try:
-            await self._connections[id].close()
+            await client.close()
 
         except Exception as error:
-            self._logger.error(f"Judge server#{id} raise exception while disconnecting, detail")
+            self._logger.error(f"Judge server#{key} raise exception while disconnecting, detail")
             self._logger.exception(error)
 
-        self._retry[id] = -1
-        self._connections.pop(id, None)
+    async def disconnect(self, id):
+        if await self._forward("disconnect", id):
+            return
+
+        if id not in self._servers:
+            raise exception.ServerNotFound(id)
+
+        for key in [key for key, client in self._connections.items()
+                    if key == id or (client is not None and client.server == id)]:
+            await self._disconnect_session(key)
+        await self._wake()
 
     async def disconnects(self):
-        for key, client in self._connections.copy().items():
-            if client is None:
-                continue
-            await self.disconnect(key)
+        for key in list(self._connections.keys()):
+            await self._disconnect_session(key)
         self._connections.clear()
+        await self._wake()
 
     async def from_json(self, warn: bool = True):
-        async def job(server: data.Server):
-            self._connections[server.id] = await self.connect(uri=server.uri,
-                                                              id=server.id,
-                                                              name=server.name,
-                                                              retry=True)
-
         for server in data.get_servers().values():
-            self._reconnect_tasks.append(asyncio.create_task(job(server)))
+            self._servers[server.id] = server
+            self._reconnect_tasks.append(asyncio.create_task(self._connect_server(server, retry=True)))
 
         # if len(self._get_connections().values()) == 0 and warn is True:
         #     self._logger.warning("No judge server are connected")
@@ -175,54 +407,116 @@ class JudgeManager:
         return self._connections
 
     async def add_server(self, server: data.Server):
-        if server.id in self._connections:
+        if await self._forward("add_server", server.model_dump()):
+            return
+
+        if server.id in self._servers:
             raise exception.AlreadyConnected(server.id)
 
-        server.id = server.id if server.id is not None else str(len(self._connections))
+        server.id = server.id if server.id is not None else str(len(self._servers))
+        self._servers[server.id] = server
 
         servers = utils.read_json(data.server_json)
         servers[server.id] = server.model_dump()
         utils.write_json(data.server_json, servers)
 
-        self._reconnect_tasks.append(
-            asyncio.create_task(
-                self.connect(
-                    uri=server.uri,
-                    id=server.id,
-                    name=server.name,
-                    # where="add_server"
-                )
-            )
-        )
+        self._reconnect_tasks.append(asyncio.create_task(self._connect_server(server)))
 
     async def remove_server(self, id):
-        if id not in self._connections:
+        if await self._forward("remove_server", id):
+            return
+
+        if id not in self._servers:
             raise exception.ServerNotFound(id)
         await self.disconnect(id)
+        self._servers.pop(id, None)
+        self._speed.pop(id, None)
+        JudgeClient.forget(id)
 
         servers = utils.read_json(data.server_json)
         servers.pop(id)
         utils.write_json(data.server_json, servers)
 
-    async def status(self):
-        return [await client.status() for key, client in self._connections.items() if client is not None]
+    def status(self):
+        return [client.status() for key, client in self._connections.items() if client is not None]
+
+    async def servers(self) -> list[dict]:
+        if not self.leading:
+            return (await self._snapshot()).get("servers", [])
+        return self._server_list()
+
+    def _server_list(self) -> list[dict]:
+        return [
+            {
+                "id": server.id,
+                "name": server.name,
+                "slots": self._slots(server.id),
+                "in_flight": self._in_flight(server.id),
+                "speed": self._speed.get(server.id),
+                "sessions": [
+                    {"id": client.id, "slot": client.slot, "status": client.status(),
+                     "status_age": client.status_age}
+                    for client in self._sessions(server.id).values()
+                ]
+            }
+            for server in self._servers.values()
+        ]
 
     async def pause(self, id):
-        await self._connections[id].pause()
+        if await self._forward("pause", id):
+            return
+
+        for client in self._sessions(id).values():
+            await client.pause()
 
     async def resume(self, id):
-        await self._connections[id].resume()
+        if await self._forward("resume", id):
+            return
 
-    async def idle(self):
-        return all([status["status"] == 'idle' for status in await self.status()])
+        for client in self._sessions(id).values():
+            await client.resume()
+        await self._wake()
 
-    async def is_free(self):
+    def idle(self):
+        return all([status["status"] == 'idle' for status in self.status()])
+
+    def is_free(self):
+        """
+        Whether a submission can be dispatched now, from the locally tracked sessions
+        """
+        free = self._free_connections()
         return (
-            "idle" in [status["status"] for status in await self.status()]
-            if utils.config.judge_mode == 0 else
-            await self.idle()
+            len(free) > 0 and len(free) == len(self._get_connections())
+            if utils.config.judge_mode == 1 else
+            len(free) > 0
         )
 
+    def _split(self, problem: db.DBProblems, free: int) -> int:
+        """
+        How many servers a submission is split across in adaptive mode.
+        One more server is added while it saves more than a session costs, never taking the servers
+        that the waiting submissions need, since with a deep queue splitting only adds overhead.
+        """
+        limit = max(1, free - self._judge_queue.qsize())
+        if limit == 1:
+            return 1
+
+        costs = cost.estimate(problem)
+        if len(cost.get_runtimes(problem)) == 0 and sum(costs) > 0:
+            # Input sizes only, turn them into seconds with the measured speed of the servers
+            per_test = (sum(self._speed.values()) / len(self._speed)
+                        if len(self._speed) > 0 else
+                        utils.config.judge_default_test_time)
+            scale = per_test * len(costs) / sum(costs)
+            costs = [test * scale for test in costs]
+
+        total, longest = sum(costs), max(costs, default=0)
+        split = 1
+        while split < limit and \
+                max(total / split, longest) - max(total / (split + 1), longest) > utils.config.judge_session_overhead:
+            split += 1
+        return split
+
     # def stop_recv(self):
     #     conenctions = [client for key, client in self._connections.items() if client is not None]
     #
@@ -241,8 +535,8 @@ class JudgeManager:
     def clear_reconnect_tasks(self):
         self._reconnect_tasks = [task for task in self._reconnect_tasks if not task.done()]
 
-    async def stop_tasks(self):
-        for task in self._judge_tasks:
+    async def stop_tasks(self, rejudge: bool = True):
+        for task in [*self._judge_tasks, *self._replays]:
             task.cancel()
             try:
                 await task
@@ -256,31 +550,331 @@ class JudgeManager:
             except asyncio.CancelledError:
                 pass
 
+        if not rejudge:
+            return
+
+        for task in self._rejudges.values():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def drain(self, timeout: float = None) -> dict[str, int]:
+        """
+        Let the running judges finish for up to timeout seconds, the loop must be stopped first.
+        Judges still running then are cancelled and, like the waiting jobs, left in Redis for the next process.
+        """
+        timeout = utils.config.judge_drain_timeout if timeout is None else timeout
+        self.clear_judge_task()
+
+        done, pending = set(), set(self._judge_tasks) | self._replays
+        if len(pending) > 0 and timeout > 0:
+            self._logger.info(f"Waiting up to {timeout}s for {len(pending)} running judge(s)...")
+            done, pending = await asyncio.wait(pending, timeout=timeout)
+
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        report = {"drained": len(done), "requeued": len(pending), "waiting": self._judge_queue.qsize()}
+        self._logger.info(f"Drained {report['drained']} judge(s), left {report['requeued']} in flight "
+                          f"and {report['waiting']} waiting for the next process")
+        if self._judge_queue.client is None and report["requeued"] + report["waiting"] > 0:
+            self._logger.warning("Without Redis the judge queue is not persisted, unfinished jobs are lost")
+        return report
+
     async def heartbeat(self):
         while not self.stop.is_set():
-            for client in self._connections.copy().values():
+            for client in self._get_connections().copy().values():
                 if client.is_closed and client.id not in self._retry:
                     self._logger.warning(f"Judge server#{client.id} is closed, reconnecting...")
-                    self._reconnect_tasks.append(
-                        asyncio.create_task(
-                            self.connect(
-                                client=client,
-                                retry=True,
-                                # where="heartbeat"
-                            )
-                        )
-                    )
+                    self._reconnect_tasks.append(asyncio.create_task(self._reconnect(client)))
+
+            try:
+                for job in await self._judge_queue.expire():
+                    self._logger.warning(f"Judge job {job.id} timed out, requeued")
+
+                await self._judge_queue.beat()
+                # Jobs of a process that stopped meanwhile
+                await self.recover()
+            except Exception as error:
+                self._logger.error("Recover judge jobs raise exception, detail")
+                self._logger.exception(error)
+
+            if self.coordinated:
+                try:
+                    await self._publish()
+                except Exception as error:
+                    self._logger.error("Publish dispatch status raise exception, detail")
+                    self._logger.exception(error)
 
             await asyncio.sleep(utils.config.heartbeat_interval)
 
+    async def _reconnect(self, client: JudgeClient):
+        if await self.connect(client=client, retry=True) is not None:
+            await self._wake()
+
+    async def sweeper(self):
+        """
+        Periodically delete archived judge queues from Redis
+        """
+        while not self.stop.is_set():
+            try:
+                keep = {f"judge::{job_id}" for job_id in await self._judge_queue.pending()}
+                count, reclaimed = await db.queue_manager.sweep("judge::*", keep)
+                if count > 0:
+                    self._logger.info(f"Swept {count} judge queue(s), reclaimed {reclaimed} bytes")
+
+            except asyncio.CancelledError:
+                break
+
+            except Exception as error:
+                self._logger.error("Sweeper raise exception, detail")
+                self._logger.exception(error)
+
+            await asyncio.sleep(utils.config.queue_sweep_interval)
+
     async def add_submission(self,
                              submission_id: str,
                              msg: RedisQueue,
+                             priority: Priority = "normal",
+                             user: str = None,
+                             use_cache: bool = True,
                              # abort: asyncio.Event
                              ):
         await msg.put(['waiting', None])
         # self._judge_abort[submission_id] = abort
-        await self._judge_queue.put((submission_id, msg))
+        job = Job(id=msg.name.removeprefix("judge::"),
+                  submission=submission_id,
+                  queue=msg.name,
+                  priority=priority,
+                  user=user,
+                  verdict=await asyncio.to_thread(self._verdict_key, submission_id))
+
+        if use_cache and job.verdict is not None:
+            cached = await self._verdicts.get(job.verdict)
+            if cached is not None:
+                task = asyncio.create_task(self._replay(submission_id, cached, msg))
+                self._replays.add(task)
+                task.add_done_callback(self._replays.discard)
+                return
+
+        if self.coordinated:
+            # The elected worker writes the rest of the progress
+            await msg.flush()
+            db.queue_manager.release(msg.name)
+        else:
+            self._messages[job.id] = msg
+        await self._judge_queue.put(job)
+
+    @staticmethod
+    def _verdict_key(submission_id: str) -> str | None:
+        try:
+            submission = db.get_submission(submission_id)
+            return verdict.key(submission, db.get_problem(submission.problem))
+        except (db.exception.SubmissionNotFound, db.exception.ProblemNotFound):
+            return None
+
+    async def _replay(self, submission_id: str, cached: Verdict, msg: RedisQueue):
+        """
+        Finish a submission from the verdict of an identical one, without a judge server
+        """
+        try:
+            submission = db.get_submission(submission_id)
+            await msg.put(['cached', None])
+            for log in cached.logs:
+                await msg.put(log)
+            await self._persist(submission, db.declare.SubmissionResult(**cached.result), msg)
+
+        except Exception as error:
+            self._logger.error(f"Replay cached verdict of {submission_id} raise exception, detail")
+            self._logger.exception(error)
+            await msg.put({'error': 'replay failed'})
+            await msg.close()
+
+    async def new_queue_id(self, submission_id: str) -> str | None:
+        """
+        A judge id for the submission whose queue does not exist yet, None when they ran out
+        """
+        check = 0
+        judge_id = utils.rand_uuid(1)
+        while await db.queue_manager.exists(f"judge::{submission_id}:{judge_id}"):
+            judge_id = utils.rand_uuid(1)
+            check += 1
+            if check > 1000000:
+                return None
+        return f"{submission_id}:{judge_id}"
+
+    async def rejudge(self,
+                      problem_id: str,
+                      submissions: dict[str, str],
+                      rate: float = None,
+                      use_cache: bool = True) -> RejudgeProgress:
+        """
+        Rejudge submissions, given as submission id -> submitter
+        """
+        try:
+            if (await self.rejudge_progress(problem_id)).state == "running":
+                raise exception.RejudgeRunning(problem_id)
+        except exception.RejudgeNotFound:
+            pass
+
+        async def enqueue(submission_id: str) -> str:
+            queue_id = await self.new_queue_id(submission_id)
+            if queue_id is None:
+                raise ValueError("Out of judge id")
+            await self.add_submission(submission_id,
+                                      db.queue_manager.create(f"judge::{queue_id}"),
+                                      "rejudge",
+                                      submissions[submission_id],
+                                      use_cache)
+            return queue_id
+
+        record = RejudgeRecord(problem=problem_id, total=len(submissions), rate=rate or utils.config.rejudge_rate)
+        # Another worker started one meanwhile
+        if not await self._rejudge_store.start(record):
+            raise exception.RejudgeRunning(problem_id)
+
+        rejudge = Rejudge(self._rejudge_store, record, list(submissions.keys()))
+        self._rejudges[problem_id] = asyncio.create_task(rejudge.run(enqueue))
+        return record.progress([], set(), True)
+
+    async def rejudge_progress(self, problem_id: str) -> RejudgeProgress:
+        record = await self._rejudge_store.get(problem_id)
+        if record is None:
+            raise exception.RejudgeNotFound(problem_id)
+
+        return record.progress(await self._rejudge_store.jobs(problem_id),
+                               await self._judge_queue.pending(),
+                               await self._rejudge_store.alive(problem_id))
+
+    async def cancel_rejudge(self, problem_id: str) -> RejudgeProgress:
+        """
+        Stop enqueueing and drop the rejudge jobs that are still waiting, running ones finish
+        """
+        if await self._rejudge_store.get(problem_id) is None:
+            raise exception.RejudgeNotFound(problem_id)
+
+        # The worker enqueueing it stops at its next submission
+        await self._rejudge_store.set_state(problem_id, "cancelled")
+
+        task = self._rejudges.pop(problem_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        for job in await self._judge_queue.cancel(set(await self._rejudge_store.jobs(problem_id))):
+            msg = self._message_queue(job)
+            await msg.put(['cancelled', None])
+            await msg.close()
+            self._messages.pop(job.id, None)
+
+        return await self.rejudge_progress(problem_id)
+
+    async def queue_status(self):
+        if not self.leading:
+            return (await self._snapshot()).get("queue", self._queue_status())
+        return self._queue_status()
+
+    async def queue_users(self):
+        if not self.leading:
+            return (await self._snapshot()).get("users", {})
+        return self._queue_users()
+
+    async def admission(self):
+        if not self.leading:
+            return (await self._snapshot()).get("admission", self._admission())
+        return self._admission()
+
+    async def admit(self, priority: Priority) -> float | None:
+        """
+        Seconds to wait before retrying when the queue is full for the class, None when a job is admitted
+        """
+        overall = await self.admission()
+        stats = (await self.queue_status()).get(priority)
+
+        excess = overall["depth"] - overall["limit"] + 1 if overall["limit"] > 0 else 0
+        if stats is not None and stats["limit"] > 0:
+            excess = max(excess, stats["depth"] - stats["limit"] + 1)
+        if excess <= 0:
+            return None
+
+        if overall["drain_rate"] > 0:
+            return max(1.0, excess / overall["drain_rate"])
+        # Nothing finished lately, fall back to how long jobs of the class have waited
+        return max(1.0, stats["wait"] if stats is not None else 0, utils.config.heartbeat_interval)
+
+    def _queue_status(self):
+        return {priority: stats.model_dump() for priority, stats in self._judge_queue.stats().items()}
+
+    def _admission(self):
+        return self._judge_queue.admission().model_dump()
+
+    def _queue_users(self):
+        return {user: stats.model_dump() for user, stats in self._judge_queue.users().items()}
+
+    async def recover(self):
+        """
+        Re-enqueue jobs left by processes that stopped
+        """
+        jobs = await self._judge_queue.recover()
+        for job in jobs:
+            await self._message_queue(job).put(['requeued', None])
+
+        if len(jobs) > 0:
+            self._logger.info(f"Recovered {len(jobs)} judge job(s)")
+        return jobs
+
+    def _message_queue(self, job: Job) -> RedisQueue:
+        if job.id in self._messages:
+            return self._messages[job.id]
+
+        if db.queue_manager.check(job.queue):
+            msg = db.queue_manager.get(job.queue)
+        else:
+            msg = db.queue_manager.create(job.queue)
+        self._messages[job.id] = msg
+        return msg
+
+    async def _persist(self,
+                       submission: db.DBSubmissions,
+                       result: db.declare.SubmissionResult,
+                       msg: RedisQueue,
+                       job: Job = None):
+        if job is not None and not await self._judge_queue.claim(job):
+            self._logger.warning(f"Result of judge job {job.id} is persisted by another attempt, skipped")
+            # The other attempt closes and archives the queue
+            self._messages.pop(job.id, None)
+            db.queue_manager.release(msg.name)
+            self._judge_queue.forget(job)
+            return
+
+        submission.result = result
+        db.update_submission(submission.id, submission)
+
+        await msg.put(['overall', result.model_dump()])
+        # await msg.put(['done'])
+        try:
+            await msg.write_log(submission.id)
+        except db.exception.SubmissionLogAlreadyExist:
+            pass
+
+        if job is not None and job.verdict is not None and verdict.cacheable(result):
+            logs = [
+                log for log in await msg.get_all()
+                if not (isinstance(log, list) and len(log) > 0 and log[0] in verdict.skipped)
+            ]
+            await self._verdicts.set(job.verdict, Verdict(result=result.model_dump(), logs=logs))
+
+        await msg.close()
+
+        if job is not None:
+            self._messages.pop(job.id, None)
+            await self._judge_queue.ack(job)
 
     async def loop(self, skip_check_connection: bool = False):
         while not self.stop.is_set():
@@ -288,9 +882,7 @@ class JudgeManager:
             if len(self._get_connections().values()) == 0 and not skip_check_connection:
                 self._logger.warning("Loop will sleep until a connection is created.")
 
-                while len(self._get_connections().values()) == 0 and not self.stop.is_set():
-                    self.clear_reconnect_tasks()
-                    await asyncio.sleep(1)
+                await self._wait_for(lambda: len(self._get_connections().values()) > 0)
 
                 if not self.stop.is_set():
                     self._logger.info("Found one (or more :D) judge server, starting loop...")
@@ -303,90 +895,105 @@ class JudgeManager:
             self.clear_judge_task()
             self.clear_reconnect_tasks()
 
-            # self._logger.debug(("looping...", [status['status'] for status in await self.status()]))
-            if await self.is_free():
-                # self._logger.debug("Judge server is free")
-                data = await self._judge_queue.get()
-                # self._logger.debug(data)
-                submission_id, msg = data
+            await self._wait_for(self.is_free)
+            if self.stop.is_set():
+                break
 
-                try:
-                    submission = db.get_submission(submission_id)
+            job = await self._judge_queue.get()
 
-                except db.exception.SubmissionNotFound:
-                    await msg.put({'error': 'submission not found'})
-                    continue
+            # Servers may be taken while waiting for a submission
+            try:
+                await self._wait_for(self.is_free)
+            except asyncio.CancelledError:
+                await self._judge_queue.requeue(job)
+                raise
+            if self.stop.is_set():
+                await self._judge_queue.requeue(job)
+                break
 
-                try:
-                    problem = db.get_problem(submission.problem)
-                except db.exception.ProblemNotFound:
-                    await msg.put({'error': 'problem not found'})
-                    continue
+            msg = self._message_queue(job)
+
+            try:
+                submission = db.get_submission(job.submission)
+
+            except db.exception.SubmissionNotFound:
+                await msg.put({'error': 'submission not found'})
+                await self._judge_queue.ack(job)
+                continue
+
+            try:
+                problem = db.get_problem(submission.problem)
+            except db.exception.ProblemNotFound:
+                await msg.put({'error': 'problem not found'})
+                await self._judge_queue.ack(job)
+                continue
+
+            match utils.config.judge_mode:
+                case 0:
+                    keys = [min(self._free_connections(), key=self._load)]
+                case 1:
+                    keys = self._free_connections()
+                case 2:
+                    free = sorted(self._free_connections(), key=self._load)
+                    keys = free[:self._split(problem, len(free))]
+                case _:
+                    raise ValueError("Invalid judge mode")
+
+            self._busy.update(keys)
+            self._judge_tasks.append(asyncio.create_task(self._dispatch(job, submission, problem, msg, keys)))
+
+    async def _dispatch(self,
+                        job: Job,
+                        submission: db.DBSubmissions,
+                        problem: db.DBProblems,
+                        msg: RedisQueue,
+                        keys: list[str]):
+        try:
+            match utils.config.judge_mode:
+                case 0 | 2 if len(keys) == 1:
+                    await self.judge_psps(
+                        submission=submission,
+                        problem=problem,
+                        msg=msg,
+                        job=job,
+                        connection=self._connections[keys[0]],
+                    )
+                case 1 | 2:
+                    await self.judge_ptps(
+                        submission=submission,
+                        problem=problem,
+                        msg=msg,
+                        job=job,
+                        connections=[self._connections[key] for key in keys],
+                    )
+
+        except exception.ServerBusy:
+            await self._judge_queue.requeue(job)
+
+        except asyncio.CancelledError:
+            # Left in flight, the next process will pick it up
+            await msg.put(['requeued', None])
 
-                # abort = self._judge_abort.get(submission_id, None)
-
-                # if not abort:
-                #     await msg.put({'error': 'abort not found'})
-                #     continue
-
-                # if not abort.is_set():
-                match utils.config.judge_mode:
-                    case 0:
-                        async def job():
-                            try:
-                                await self.judge_psps(
-                                    submission=submission,
-                                    problem=problem,
-                                    msg=msg,
-                                    # abort=abort
-                                )
-                            except exception.ServerBusy:
-                                await self._judge_queue.put((submission_id, msg))
-
-                            except asyncio.CancelledError:
-                                await msg.put({'error': 'cancelled'})
-
-                        self._judge_tasks.append(asyncio.create_task(job()))
-                    case 1:
-                        try:
-                            await self.judge_ptps(
-                                submission=submission,
-                                problem=problem,
-                                msg=msg,
-                                # abort=abort
-                            )
-                        except exception.ServerBusy:
-                            await self._judge_queue.put((submission_id, msg))
-
-                        except asyncio.CancelledError:
-                            await msg.put({'error': 'cancelled'})
-
-                    case _:
-                        raise ValueError("Invalid judge mode")
-
-                # else:
-                #     msg.put(['abort'])
-
-            # self._logger.debug("Setup compelete, now wait........")
-
-        # await asyncio.sleep(1)
+        finally:
+            self._busy.difference_update(keys)
+            await self._wake()
 
     async def judge_psps(self,
                          submission: db.DBSubmissions,
                          problem: db.Problems,
                          msg: RedisQueue,
+                         job: Job = None,
+                         connection: JudgeClient = None,
                          # abort: asyncio.Event
                          ):
-        index = [
-            i for i, client in self._connections.items()
-            if not client.is_judging and (await client.status())['status'] == 'idle'
-        ]
-        self._logger.debug((index, [client.is_judging for client in self._connections.values()]))
-        if len(index) == 0:
-            # self._logger.warning("No available judge server")
-            raise exception.ServerBusy()
-        connection = self._connections[index[0]]
+        if connection is None:
+            index = self._free_connections()
+            if len(index) == 0:
+                # self._logger.warning("No available judge server")
+                raise exception.ServerBusy()
+            connection = self._connections[min(index, key=self._load)]
         await msg.put(['catched', connection.name])
+        started = asyncio.get_running_loop().time()
 
         time: float = 0
         ptime: float = 0
@@ -396,6 +1003,8 @@ class JudgeManager:
         error: str = ""
         points: float = 0
         overall: int = -2
+        runtimes: dict[int, float] = {}
+        failed: int | None = None
         try:
             async for status, data in connection.judge_iter(
                     submission=submission,
@@ -410,6 +1019,7 @@ class JudgeManager:
                     await msg.put([status, data])
 
                 elif status == 'result':
+                    runtimes[len(runtimes) + 1] = data.get('time')
                     point = data.get('point', 0)
                     points += point
                     time += data.get('time', 0)
@@ -425,8 +1035,17 @@ class JudgeManager:
                         }
                     ])
 
+                    if problem.stop_on_first_failure and failed is None and \
+                            data.get('status', declare.StatusCode.ACCEPTED.value) != declare.StatusCode.ACCEPTED.value:
+                        failed = data.get('status')
+                        connection.abort()
+
                 elif status == 'overall':
-                    overall = data
+                    overall = data if failed is None else failed
+
+                elif status == 'abort' and failed is not None:
+                    overall = failed
+                    break
 
                 elif status == 'compiler':
                     warn = data
@@ -463,6 +1082,13 @@ class JudgeManager:
             error = str(e)
             overall = declare.StatusCode.SYSTEM_ERROR.value
 
+        if time != -1:
+            if failed is None:
+                self._record_speed(connection.server,
+                                   asyncio.get_running_loop().time() - started,
+                                   problem.total_testcases)
+            cost.record(problem, runtimes)
+
         result = db.declare.SubmissionResult(
             status=overall if overall >= -1 else declare.StatusCode.SYSTEM_ERROR.value,
             warn=warn,
@@ -474,13 +1100,7 @@ class JudgeManager:
             ),
             point=points
         )
-        submission.result = result
-        db.update_submission(submission.id, submission)
-
-        await msg.put(['overall', result.model_dump()])
-        # await msg.put(['done'])
-        await msg.write_log(submission.id)
-        await msg.close()
+        await self._persist(submission, result, msg, job)
 
         return
 
@@ -488,116 +1108,306 @@ class JudgeManager:
                          submission: db.DBSubmissions,
                          problem: db.Problems,
                          msg: RedisQueue,
+                         job: Job = None,
+                         connections: list[JudgeClient] = None,
                          # abort: asyncio.Event
                          ):
+        if connections is None:
+            connections = list(self._get_connections().values())
+
         await msg.put(['catched', None])
-        test_chunk = utils.chunks(range(1, problem.total_testcases + 1), len(self._connections))
 
         # self._thread_manager.clear_threads("judge_manager.threads.judge:*")
         self.clear_judge_task()
 
         job_error = []
         judge_msg = asyncio.Queue()
+        tasks: list[asyncio.Task] = []
+        cursor = 1
+        drained = asyncio.Event()
+        changed = asyncio.Event()
+        costs = cost.estimate(problem)
+        time_limit = cost.time_limit(problem)
+        runtimes: dict[int, float] = {}
+        # Fail-fast state: failing test index -> status, and the next test index of every running session
+        failed: dict[int, int] = {}
+        positions: dict[JudgeClient, int] = {}
+        # Running batches: batch, deadline and whether it was already re-dispatched
+        active: dict[JudgeClient, list] = {}
+        # Re-dispatched ranges, with the server that gave them up
+        retry: collections.deque[tuple[int, int, JudgeClient]] = collections.deque()
+        sessions: dict[JudgeClient, asyncio.Task] = {}
+        # Re-dispatches of every first unfinished test, past max_retry the tests are given up
+        redispatched: collections.Counter[int] = collections.Counter()
+        given_up = asyncio.Event()
+        # Tests with a result, the first result of a test wins
+        done: set[int] = set()
+        accepted = declare.StatusCode.ACCEPTED.value
+        clock = asyncio.get_running_loop()
+
+        def cutoff() -> int:
+            return min(failed) if failed else problem.total_testcases
+
+        def settled(low: int, high: int) -> bool:
+            """
+            Whether no test in the range is still needed
+            """
+            return all(test in done for test in range(low, min(high, cutoff()) + 1))
+
+        def complete() -> bool:
+            return drained.is_set() or given_up.is_set() or settled(1, problem.total_testcases)
+
+        def alone(connection: JudgeClient) -> bool:
+            """
+            Whether no other server is left to take re-dispatched work
+            """
+            return all(task.done() or other.is_closed for other, task in sessions.items() if other is not connection)
+
+        def take(connection: JudgeClient) -> tuple[int, int] | None:
+            """
+            Next contiguous batch: re-dispatched work first, then the pool, guided by estimated cost:
+            large while much work is left, small near the end.
+            A server does not get back the tests it gave up, unless it is the only one left.
+            """
+            nonlocal cursor
+            for item in list(retry):
+                low, high, excluded = item
+                if excluded is connection and not alone(connection):
+                    continue
 
-        async def job(i, chunk):
-            connection = list(self._connections.values())[i]
-            try:
-                async for status, data in connection.judge_iter(submission,
-                                                                problem,
-                                                                (chunk[0], chunk[-1]),
-                                                                # abort
-                                                                ):
-                    await judge_msg.put((status, data))
-            except Exception as e:
-                self._logger.error(
-                    f"Judge server#{connection.id} raise exception while judging {submission.id}, detail"
-                )
-                self._logger.exception(e)
-                job_error.append(e)
+                retry.remove(item)
+                high = min(high, cutoff())
+                while low <= high and low in done:
+                    low += 1
+                while high >= low and high in done:
+                    high -= 1
+                if low <= high:
+                    return low, high
 
-        for i, chunk in enumerate(test_chunk):
-            if len(chunk) == 0:
-                continue
+            if cursor > cutoff() or drained.is_set():
+                return None
+
+            target = sum(costs[cursor - 1:]) / (utils.config.ptps_batch_factor * len(connections))
+            end, total = cursor, 0
+            while end <= cutoff() and \
+                    (end - cursor < utils.config.ptps_min_batch or total + costs[end - 1] <= target):
+                total += costs[end - 1]
+                end += 1
+
+            batch = (cursor, end - 1)
+            cursor = end
+            return batch
+
+        def redispatch(connection: JudgeClient):
+            """
+            Hand the tests a session has not finished yet to another server
+            """
+            low = positions[connection]
+            redispatched[low] += 1
+            if redispatched[low] > utils.config.max_retry:
+                self._logger.error(f"Tests {low}-{active[connection][0][1]} of {submission.id} failed "
+                                   f"{utils.config.max_retry} re-dispatches, giving up")
+                given_up.set()
+                for other in list(active.keys()):
+                    other.abort()
+            else:
+                retry.append((low, active[connection][0][1], connection))
+            changed.set()
+
+        def fail(index: int, code: int):
+            """
+            Abort the sessions whose remaining tests all come after the first known failure,
+            sessions still below it go on since they may find an earlier one
+            """
+            failed[index] = code
+            first = min(failed)
+            for other, position in positions.items():
+                if position > first:
+                    other.abort()
+
+        async def run(connection: JudgeClient):
+            while not complete():
+                batch = take(connection)
+                if batch is None:
+                    if len(active) == 0 and len(retry) == 0:
+                        return
+                    # Idle, but a running batch may still be re-dispatched
+                    changed.clear()
+                    try:
+                        await asyncio.wait_for(changed.wait(), 1)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                index = batch[0]
+                positions[connection] = index
+                active[connection] = [
+                    batch,
+                    clock.time() + time_limit * (batch[1] - batch[0] + 1) + utils.config.judge_chunk_margin,
+                    False
+                ]
+                # Statuses of the tests this session decided, stand in for its overall when it is cut short
+                decided: list[int] = []
+                overall_sent = False
+                try:
+                    async for status, data in connection.judge_iter(submission,
+                                                                    problem,
+                                                                    batch,
+                                                                    # abort
+                                                                    ):
+                        if status in ['error:compiler', 'error:system', 'aborted']:
+                            # Every batch compiles the same source, and a retry would fail the same way
+                            drained.set()
+
+                        elif status == 'overall':
+                            overall_sent = True
+
+                        elif status == 'result':
+                            if index not in done:
+                                done.add(index)
+                                runtimes[index] = data.get('time')
+                                decided.append(data.get('status', accepted))
+                                await judge_msg.put((status, data, index))
+
+                                if problem.stop_on_first_failure and data.get('status', accepted) != accepted:
+                                    fail(index, data.get('status'))
+
+                            index += 1
+                            positions[connection] = index
+                            if index <= batch[1] and settled(index, batch[1]):
+                                # The rest of the batch is decided elsewhere, or not needed
+                                connection.abort()
+                            continue
+
+                        await judge_msg.put((status, data, None))
+
+                    if not overall_sent:
+                        for code in decided:
+                            await judge_msg.put(('overall', code, None))
+
+                    if not complete() and not settled(index, batch[1]) and not active[connection][2]:
+                        # The session ended early, the server is likely gone
+                        self._logger.warning(f"Judge server#{connection.id} left tests {index}-{batch[1]} "
+                                             f"of {submission.id}, re-dispatching")
+                        redispatch(connection)
+                        if connection.is_closed:
+                            return
+
+                except Exception as e:
+                    self._logger.error(
+                        f"Judge server#{connection.id} raise exception while judging {submission.id}, detail"
+                    )
+                    self._logger.exception(e)
+                    job_error.append(e)
+                    for code in decided:
+                        await judge_msg.put(('overall', code, None))
+                    redispatch(connection)
+                    return
+
+                finally:
+                    positions.pop(connection, None)
+                    active.pop(connection, None)
+                    changed.set()
 
-            task = asyncio.create_task(job(i, chunk))
-            self._judge_tasks.append(task)
+        for connection in connections:
+            sessions[connection] = asyncio.create_task(run(connection))
+            tasks.append(sessions[connection])
 
         def running():
-            return all([not task.done() for task in self._judge_tasks])
+            return any([not task.done() for task in tasks])
+
+        def overdue():
+            now = clock.time()
+            for connection, state in list(active.items()):
+                if positions[connection] <= state[0][1] and settled(positions[connection], state[0][1]):
+                    # A straggler whose tests were decided elsewhere
+                    connection.abort()
+
+                elif not state[2] and now > state[1]:
+                    state[2] = True
+                    self._logger.warning(f"Judge server#{connection.id} is late on tests "
+                                         f"{positions[connection]}-{state[0][1]} of {submission.id}, "
+                                         f"re-dispatching")
+                    redispatch(connection)
 
         statuss = {}
         warns: set[str] = set()
         errors: set[str] = set()
-        total_time: float = 0
-        ptime: float = 0
-        amemory: float = 0
-        pmemory: float = 0
-        points: float = 0
+        results: dict[int, dict] = {}
         overall: list[declare.StatusCode] = []
-        while running() or not judge_msg.empty():
-            if len(job_error) > 0:
-                errors.update(job_error)
-                job_error.clear()
-
-            try:
-                status, data = await asyncio.wait_for(judge_msg.get(), timeout=1)
-            except asyncio.TimeoutError:
-                continue
-            # print([status, data])
+        try:
+            while running() or not judge_msg.empty():
+                overdue()
 
-            # self._logger.debug([status, data])
+                try:
+                    status, data, index = await asyncio.wait_for(judge_msg.get(), timeout=1)
+                except asyncio.TimeoutError:
+                    continue
+                # print([status, data])
 
-            if status in ['initting', 'judging']:
-                if status not in statuss:
-                    statuss[status] = 0
-                statuss[status] += 1
+                # self._logger.debug([status, data])
 
-                if statuss[status] == len(self._connections):
-                    await msg.put([status, data])
-                    del statuss[status]
+                if status in ['initting', 'judging']:
+                    # Every batch is a session of its own, announce only the first one
+                    if status not in statuss:
+                        statuss[status] = True
+                        await msg.put([status, data])
 
-            elif status in ['error:compiler', 'error:system']:
-                overall.append({
-                    "status":
+                elif status in ['error:compiler', 'error:system']:
+                    overall.append(
                         declare.StatusCode.SYSTEM_ERROR.value
                         if status == 'error:system' else
                         declare.StatusCode.COMPILE_ERROR.value
-                })
-                errors.add(data)
-            # total_time = -1
-            # amemory = -1
-            # pmemory = -1
-
-            elif status in ['debug', 'done']:
-                pass
+                    )
+                    errors.add(data)
 
-            elif status == 'compiler':
-                warns.add(data)
+                elif status in ['debug', 'done', 'abort']:
+                    pass
 
-            elif status == 'overall':
-                overall.append(data)
+                elif status == 'compiler':
+                    warns.add(data)
 
-            elif status == 'aborted':
-                overall.append(declare.StatusCode.ABORTED.value)
+                elif status == 'overall':
+                    overall.append(data)
 
-            elif status == 'result':
-                point = data.get('point', 0)
-                points += point
-                total_time += data.get('time', 0)
-                ptime = max(ptime, data.get('time', 0))
-                amemory += data.get('memory', (0, 0))[0]
-                pmemory += data.get('memory', (0, 0))[1]
+                elif status == 'aborted':
+                    overall.append(declare.StatusCode.ABORTED.value)
 
-                await msg.put([
-                    status,
-                    {
+                elif status == 'result':
+                    results[index] = {
                         **data,
-                        "point": point
+                        "point": data.get('point', 0)
                     }
-                ])
+                    await msg.put([status, results[index]])
+
+        finally:
+            # Only left running when this judge is cancelled, give the sessions a moment to abort cleanly
+            for connection in list(active.keys()):
+                connection.abort()
+            if running():
+                await asyncio.wait(tasks, timeout=utils.config.recv_timeout + 1)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if given_up.is_set() or not complete():
+            # Some tests never got a result from any server
+            errors.update(str(error) for error in job_error)
+            errors.add("Not every testcase was judged")
+        elif len(errors) == 0:
+            cost.record(problem, runtimes)
+
+        # With fail-fast, tests after the first failure may or may not have run, leave them out
+        if failed:
+            results = {index: data for index, data in results.items() if index <= min(failed)}
+        points = sum(data['point'] for data in results.values())
+        total_time = sum(data.get('time', 0) for data in results.values())
+        ptime = max([data.get('time', 0) for data in results.values()], default=0)
+        amemory = sum(data.get('memory', (0, 0))[0] for data in results.values())
+        pmemory = sum(data.get('memory', (0, 0))[1] for data in results.values())
 
         result: db.declare.SubmissionResult = None
-        if "aborted" in overall:
+        if declare.StatusCode.ABORTED.value in overall:
             result = db.declare.SubmissionResult(
                 status=declare.StatusCode.ABORTED.value,
                 time=(-1, -1, -1),
@@ -608,10 +1418,13 @@ class JudgeManager:
             )
 
         else:
+            if failed:
+                overall = [failed[min(failed)]]
             overall.sort(key=lambda result: result)
-            print(overall, errors)
             result = db.declare.SubmissionResult(
-                status=overall[0] if len(errors) == 0 else declare.StatusCode.SYSTEM_ERROR.value,
+                status=(overall[0]
+                        if len(errors) == 0 and len(overall) > 0 else
+                        declare.StatusCode.SYSTEM_ERROR.value),
                 time=(-1, -1, -1) if total_time == -1 else (total_time, total_time / problem.total_testcases, ptime),
                 warn="\n".join(list(warns)),
                 error="\n".join(list(errors)),
@@ -622,12 +1435,6 @@ class JudgeManager:
                 point=points
             )
 
-        submission.result = result
-        await msg.put(['overall', result.model_dump()])
-        # await msg.put(['done'])
-        await msg.write_log(submission.id)
-        await msg.close()
-
-        db.update_submission(submission.id, submission)
+        await self._persist(submission, result, msg, job)
 
         return
@@ -0,0 +1,442 @@
+import asyncio
+import collections
+import time
+import typing
+import uuid
+
+import pydantic
+import redis.asyncio as redis
+
+import declare
+import utils
+
+
+Priority = typing.Literal["contest", "normal", "rejudge", "background"]
+priorities: list[str] = list(typing.get_args(Priority))
+
+
+class Job(declare.PydanticIndexable):
+    id: str
+    submission: str
+    queue: str
+    priority: Priority = "normal"
+    # Submitter, for fair share between users
+    user: str | None = None
+    # Verdict cache key, see judge.verdict
+    verdict: str | None = None
+    enqueued_at: float = pydantic.Field(default_factory=time.time)
+    attempts: int = 0
+    # Process holding the job, see JudgeQueue.token
+    owner: str | None = None
+
+
+class ClassStats(declare.PydanticIndexable):
+    depth: int
+    oldest: float
+    wait: float
+    # 0 for no limit
+    limit: int = 0
+    # Seconds a job enqueued now would wait, None while no job finished recently
+    estimate: float | None = None
+
+
+class AdmissionStats(declare.PydanticIndexable):
+    depth: int
+    limit: int
+    # Jobs finished per second
+    drain_rate: float
+    estimate: float | None
+
+
+class UserStats(declare.PydanticIndexable):
+    waiting: int
+    running: int
+
+
+class JudgeQueue:
+    """
+    Submissions waiting to be judged.
+    Every job stays in Redis until its result is persisted, so waiting and in-flight jobs survive a restart.
+    Inside a priority class, users take turns (deficit round robin with one job per turn),
+    so one user with many submissions does not hold back the others.
+    When coordinated, put only hands the job to the elected dispatcher, which takes it with receive.
+    Every job is owned by one process, the others recover it only once that process stops beating.
+    """
+    jobs_key: str = "judge:jobs"
+    inflight_key: str = "judge:inflight"
+    done_key: str = "judge:done:{id}"
+    incoming_key: str = "judge:incoming"
+    alive_key: str = "judge:alive:{token}"
+    recover_key: str = "judge:recover"
+    # Seconds to store a claimed result, another attempt may claim the job after that
+    claim_timeout: int = 60
+
+    client: redis.Redis | None
+    coordinated: bool
+    token: str
+    _waiting: dict[str, collections.OrderedDict[str, collections.deque[Job]]]
+    _changed: asyncio.Condition
+    _inflight: dict[str, Job]
+    _wait: dict[str, float]
+    _finished: collections.deque[float]
+    _started: float
+
+    def __init__(self, client: redis.Redis = None, coordinated: bool = False):
+        self.client = client
+        self.coordinated = coordinated and client is not None
+        self.token = uuid.uuid4().hex
+        self._waiting = {priority: collections.OrderedDict() for priority in priorities}
+        self._changed = asyncio.Condition()
+        self._inflight = {}
+        self._wait = {priority: 0 for priority in priorities}
+        self._finished = collections.deque()
+        self._started = time.monotonic()
+
+    async def _push(self, job: Job, front: bool = False):
+        users = self._waiting[job.priority]
+        waiting = users.setdefault(job.user or "", collections.deque())
+        if front:
+            waiting.appendleft(job)
+            users.move_to_end(job.user or "", last=False)
+        else:
+            waiting.append(job)
+
+        await self._notify()
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _running(self, user: str) -> int:
+        return len([job for job in self._inflight.values() if (job.user or "") == user])
+
+    def _eligible(self, priority: str) -> str | None:
+        """
+        The user whose turn it is in a class, skipping users at their concurrency cap
+        """
+        cap = utils.config.judge_user_concurrency
+        for user in self._waiting[priority]:
+            if cap <= 0 or user == "" or self._running(user) < cap:
+                return user
+        return None
+
+    def _ready(self) -> bool:
+        return any(self._eligible(priority) is not None for priority in priorities)
+
+    def _rank(self, job: Job, now: float) -> float:
+        """
+        Class index, lowered by one for every judge_priority_aging seconds waited so no class starves
+        """
+        return priorities.index(job.priority) - (now - job.enqueued_at) / utils.config.judge_priority_aging
+
+    def _pop(self) -> Job:
+        now = time.time()
+        heads = []
+        for priority, users in self._waiting.items():
+            user = self._eligible(priority)
+            if user is not None:
+                heads.append(users[user][0])
+
+        job = min(heads, key=lambda job: (self._rank(job, now), job.enqueued_at))
+        users = self._waiting[job.priority]
+        user = job.user or ""
+        users[user].popleft()
+        # End of the turn
+        if len(users[user]) > 0:
+            users.move_to_end(user)
+        else:
+            del users[user]
+
+        # Moving average of the time spent waiting
+        self._wait[job.priority] = self._wait[job.priority] * 0.8 + (now - job.enqueued_at) * 0.2
+        return job
+
+    async def put(self, job: Job):
+        if self.coordinated:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.hset(self.jobs_key, job.id, job.model_dump_json())
+                pipe.rpush(self.incoming_key, job.id)
+                await pipe.execute()
+            return
+
+        job.owner = self.token
+        if self.client is not None:
+            await self.client.hset(self.jobs_key, job.id, job.model_dump_json())
+        await self._push(job)
+
+    def _has(self, job_id: str) -> bool:
+        return job_id in self._inflight or any(job.id == job_id for job in self._jobs())
+
+    async def receive(self, timeout: int = 1) -> Job | None:
+        """
+        Take one job put by any API worker into the local queue
+        """
+        item = await self.client.blpop([self.incoming_key], timeout=timeout)
+        if item is None:
+            return None
+
+        job_id = item[1].decode()
+        raw = await self.client.hget(self.jobs_key, job_id)
+        # Cancelled or finished, or already taken by recover
+        if raw is None or self._has(job_id):
+            return None
+
+        job = Job.model_validate_json(raw)
+        job.owner = self.token
+        await self.client.hset(self.jobs_key, job_id, job.model_dump_json())
+        await self._push(job)
+        return job
+
+    async def get(self) -> Job:
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(self._ready)
+                job = self._pop()
+
+            # Another worker may have cancelled it
+            if self.client is None or await self.client.hexists(self.jobs_key, job.id):
+                break
+
+        job.attempts += 1
+        self._inflight[job.id] = job
+
+        if self.client is not None:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.hset(self.jobs_key, job.id, job.model_dump_json())
+                pipe.hset(self.inflight_key, job.id, time.time() + utils.config.judge_visibility_timeout)
+                await pipe.execute()
+
+        return job
+
+    async def requeue(self, job: Job):
+        """
+        Put an in-flight job back to the waiting queue
+        """
+        self._inflight.pop(job.id, None)
+        if self.client is not None:
+            await self.client.hdel(self.inflight_key, job.id)
+        await self._push(job, front=True)
+
+    async def claim(self, job: Job) -> bool:
+        """
+        Return True only for the one attempt that stores the result, ack then marks the job done.
+        The claim expires after claim_timeout seconds, so a process dying before ack does not lose the job.
+        """
+        if self.client is None:
+            return self._inflight.pop(job.id, None) is not None
+
+        return bool(await self.client.set(self.done_key.format(id=job.id), "claimed", nx=True, ex=self.claim_timeout))
+
+    def forget(self, job: Job):
+        """
+        Drop an in-flight job locally only, another attempt finishes it
+        """
+        self._inflight.pop(job.id, None)
+
+    async def ack(self, job: Job):
+        self._inflight.pop(job.id, None)
+        self._finished.append(time.monotonic())
+        if self.client is not None:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.set(self.done_key.format(id=job.id), "done", ex=utils.config.judge_visibility_timeout * 2)
+                pipe.hdel(self.jobs_key, job.id)
+                pipe.hdel(self.inflight_key, job.id)
+                await pipe.execute()
+
+        # The user may be under its cap again
+        await self._notify()
+
+    async def beat(self):
+        """
+        Keep the jobs of this process from being recovered by the others
+        """
+        if self.client is not None:
+            await self.client.set(self.alive_key.format(token=self.token), 1, ex=utils.config.heartbeat_interval * 3)
+
+    async def retire(self):
+        """
+        Leave the jobs of this process to the others right away
+        """
+        if self.client is not None:
+            await self.client.delete(self.alive_key.format(token=self.token))
+
+    async def _orphan(self, job: Job) -> bool:
+        if self._has(job.id):
+            return False
+        if job.owner is None or job.owner == self.token:
+            return True
+        return not await self.client.exists(self.alive_key.format(token=job.owner))
+
+    async def recover(self) -> list[Job]:
+        """
+        Take over every job that was waiting or in flight in a process that stopped.
+        Only one process recovers at a time, so each job is taken over once.
+        """
+        if self.client is None:
+            return []
+
+        if not await self.client.set(self.recover_key, self.token, nx=True, ex=self.claim_timeout):
+            return []
+
+        try:
+            await self.beat()
+            jobs = [Job.model_validate_json(job) for job in (await self.client.hgetall(self.jobs_key)).values()]
+            jobs.sort(key=lambda job: job.enqueued_at)
+
+            recovered = []
+            for job in jobs:
+                if not await self._orphan(job):
+                    continue
+
+                done = await self.client.get(self.done_key.format(id=job.id))
+                if done == b"done":
+                    await self.ack(job)
+                    continue
+                # Claimed, its result is being stored
+                if done is not None:
+                    continue
+
+                job.owner = self.token
+                async with self.client.pipeline(transaction=True) as pipe:
+                    pipe.hset(self.jobs_key, job.id, job.model_dump_json())
+                    pipe.hdel(self.inflight_key, job.id)
+                    await pipe.execute()
+                await self._push(job)
+                recovered.append(job)
+
+            return recovered
+
+        finally:
+            await self.client.delete(self.recover_key)
+
+    async def expire(self) -> list[Job]:
+        """
+        Re-enqueue in-flight jobs whose visibility timeout passed, jobs of other processes are left to recover
+        """
+        if self.client is None:
+            return []
+
+        now = time.time()
+        expired = []
+        for job_id, deadline in (await self.client.hgetall(self.inflight_key)).items():
+            job_id = job_id.decode()
+            if float(deadline) > now:
+                continue
+
+            job = self._inflight.get(job_id)
+            if job is None:
+                if not await self.client.hexists(self.jobs_key, job_id):
+                    await self.client.hdel(self.inflight_key, job_id)
+                continue
+
+            await self.requeue(job)
+            expired.append(job)
+
+        return expired
+
+    def reset(self):
+        """
+        Forget the local jobs, they stay in Redis for the next dispatcher
+        """
+        self._waiting = {priority: collections.OrderedDict() for priority in priorities}
+        self._inflight = {}
+
+    async def cancel(self, ids: set[str]) -> list[Job]:
+        """
+        Drop waiting jobs, jobs already in flight are left to finish
+        """
+        cancelled = []
+        for users in self._waiting.values():
+            for user, waiting in list(users.items()):
+                kept = collections.deque()
+                for job in waiting:
+                    (cancelled if job.id in ids else kept).append(job)
+
+                if len(kept) > 0:
+                    users[user] = kept
+                else:
+                    del users[user]
+
+        if self.client is not None:
+            # Waiting in another worker, which skips jobs that are no longer in Redis
+            inflight = {job_id.decode() for job_id in await self.client.hkeys(self.inflight_key)}
+            remote = list(ids - inflight - set(self._inflight.keys()) - {job.id for job in cancelled})
+            if len(remote) > 0:
+                cancelled += [
+                    Job.model_validate_json(raw)
+                    for raw in await self.client.hmget(self.jobs_key, remote)
+                    if raw is not None
+                ]
+
+        if self.client is not None and len(cancelled) > 0:
+            await self.client.hdel(self.jobs_key, *[job.id for job in cancelled])
+        return cancelled
+
+    async def pending(self) -> set[str]:
+        """
+        Ids of jobs that are not finished yet
+        """
+        if self.client is None:
+            return set(self._inflight.keys()) | {job.id for job in self._jobs()}
+        return {job_id.decode() for job_id in await self.client.hkeys(self.jobs_key)}
+
+    def _jobs(self, priority: Priority = None) -> typing.Iterator[Job]:
+        for users in ([self._waiting[priority]] if priority is not None else self._waiting.values()):
+            for waiting in users.values():
+                yield from waiting
+
+    def drain_rate(self) -> float:
+        """
+        Jobs finished per second over the last judge_drain_window seconds
+        """
+        now = time.monotonic()
+        while len(self._finished) > 0 and self._finished[0] < now - utils.config.judge_drain_window:
+            self._finished.popleft()
+        return len(self._finished) / max(1.0, min(utils.config.judge_drain_window, now - self._started))
+
+    def stats(self) -> dict[str, ClassStats]:
+        now = time.time()
+        rate = self.drain_rate()
+        ahead = 0
+        stats = {}
+        for priority in priorities:
+            depth = self.qsize(priority)
+            # Higher classes go first, ignoring aging
+            ahead += depth
+            stats[priority] = ClassStats(
+                depth=depth,
+                oldest=now - min([job.enqueued_at for job in self._jobs(priority)], default=now),
+                wait=self._wait[priority],
+                limit=utils.config.judge_class_limit.get(priority, 0),
+                estimate=ahead / rate if rate > 0 else (0 if ahead == 0 else None)
+            )
+        return stats
+
+    def admission(self) -> AdmissionStats:
+        rate = self.drain_rate()
+        depth = self.qsize()
+        return AdmissionStats(
+            depth=depth,
+            limit=utils.config.judge_queue_limit,
+            drain_rate=rate,
+            estimate=depth / rate if rate > 0 else (0 if depth == 0 else None)
+        )
+
+    def users(self) -> dict[str, UserStats]:
+        """
+        Outstanding jobs of every user
+        """
+        waiting = collections.Counter(job.user or "" for job in self._jobs())
+        running = collections.Counter(job.user or "" for job in self._inflight.values())
+        return {
+            user: UserStats(waiting=waiting[user], running=running[user])
+            for user in waiting.keys() | running.keys()
+        }
+
+    def qsize(self, priority: Priority = None) -> int:
+        return sum(len(waiting)
+                   for users in ([self._waiting[priority]] if priority is not None else self._waiting.values())
+                   for waiting in users.values())
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
@@ -0,0 +1,245 @@
+"""
+Mass rejudge of a problem's submissions, enqueued in the background at a limited rate
+"""
+
+import asyncio
+import datetime
+import logging
+import time
+import typing
+
+import pydantic
+import redis.asyncio as redis
+
+import db
+import declare
+import utils
+
+RejudgeState = typing.Literal["running", "done", "cancelled", "failed"]
+
+logger: logging.Logger = logging.getLogger("justyse.judge.rejudge")
+logger.addHandler(utils.console_handler("Rejudge"))
+
+
+class RejudgeFilter(declare.PydanticIndexable):
+    status: list[int] | None = None
+    since: datetime.datetime | None = None
+    until: datetime.datetime | None = None
+    # Submissions enqueued per second
+    rate: float | None = pydantic.Field(default=None, gt=0)
+    # Reuse cached verdicts of unchanged code and testcases
+    cache: bool = True
+
+
+class RejudgeProgress(declare.PydanticIndexable):
+    problem: str
+    state: RejudgeState
+    total: int
+    enqueued: int
+    judged: int
+    rate: float
+    started_at: float
+    eta: float | None
+
+
+def select(problem_id: str, filter: RejudgeFilter) -> dict[str, str]:
+    """
+    Submissions of a problem matching the filter, oldest first, as submission id -> submitter
+    """
+    submissions = db.get_submission_filter(lambda submission: submission.problem == problem_id)
+
+    def match(submission: db.DBSubmissions) -> bool:
+        if filter.status is not None and \
+                (submission.result is None or submission.result["status"] not in filter.status):
+            return False
+
+        created_at = datetime.datetime.fromisoformat(submission.created_at)
+        if filter.since is not None and created_at < filter.since.replace(tzinfo=None):
+            return False
+        if filter.until is not None and created_at > filter.until.replace(tzinfo=None):
+            return False
+
+        return True
+
+    submissions = [submission for submission in submissions if match(submission)]
+    submissions.sort(key=lambda submission: submission.created_at)
+    return {submission.id: submission.by for submission in submissions}
+
+
+def lease(rate: float) -> float:
+    """
+    Seconds the enqueueing worker is taken for alive, longer than the wait between two submissions
+    """
+    return max(2 / rate, utils.config.heartbeat_interval * 3)
+
+
+class RejudgeRecord(declare.PydanticIndexable):
+    problem: str
+    state: RejudgeState = "running"
+    total: int
+    rate: float
+    started_at: float = pydantic.Field(default_factory=time.time)
+
+    def progress(self, jobs: list[str], pending: set[str], alive: bool) -> RejudgeProgress:
+        judged = len([job_id for job_id in jobs if job_id not in pending])
+
+        state = self.state
+        if state == "running" and not alive:
+            # Enqueueing is over, or the worker running it stopped halfway
+            if len(jobs) < self.total:
+                state = "failed"
+            elif judged == len(jobs):
+                state = "done"
+
+        eta = None
+        if state == "running":
+            elapsed = time.time() - self.started_at
+            # Enqueueing is bound by the rate, judging by how fast the servers went so far
+            eta = max(
+                (self.total - len(jobs)) / self.rate,
+                elapsed / judged * (self.total - judged) if judged > 0 else 0
+            )
+
+        return RejudgeProgress(
+            problem=self.problem,
+            state=state,
+            total=self.total,
+            enqueued=len(jobs),
+            judged=judged,
+            rate=self.rate,
+            started_at=self.started_at,
+            eta=eta
+        )
+
+
+class RejudgeStore:
+    """
+    Stored in Redis so any worker reports and cancels a rejudge, or in process without it.
+    The worker enqueueing a rejudge holds its alive key, so only one runs per problem.
+    """
+    key: str = "judge:rejudge:{problem}"
+    jobs_key: str = "judge:rejudge:{problem}:jobs"
+    alive_key: str = "judge:rejudge:{problem}:alive"
+
+    client: redis.Redis | None
+    _records: dict[str, RejudgeRecord]
+    _jobs: dict[str, list[str]]
+    _alive: dict[str, float]
+
+    def __init__(self, client: redis.Redis = None):
+        self.client = client
+        self._records = {}
+        self._jobs = {}
+        self._alive = {}
+
+    async def start(self, record: RejudgeRecord) -> bool:
+        """
+        Replace the rejudge of the problem, False while another worker enqueues one
+        """
+        if self.client is None:
+            if await self.alive(record.problem):
+                return False
+            await self.renew(record.problem, lease(record.rate))
+            self._records[record.problem] = record
+            self._jobs[record.problem] = []
+            return True
+
+        if not await self.client.set(self.alive_key.format(problem=record.problem), 1,
+                                     nx=True, px=int(lease(record.rate) * 1000)):
+            return False
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.set(self.key.format(problem=record.problem), record.model_dump_json())
+            pipe.delete(self.jobs_key.format(problem=record.problem))
+            await pipe.execute()
+        return True
+
+    async def renew(self, problem: str, seconds: float):
+        if self.client is None:
+            self._alive[problem] = time.monotonic() + seconds
+            return
+        await self.client.set(self.alive_key.format(problem=problem), 1, px=int(seconds * 1000))
+
+    async def release(self, problem: str):
+        if self.client is None:
+            self._alive.pop(problem, None)
+            return
+        await self.client.delete(self.alive_key.format(problem=problem))
+
+    async def alive(self, problem: str) -> bool:
+        if self.client is None:
+            return self._alive.get(problem, 0) > time.monotonic()
+        return bool(await self.client.exists(self.alive_key.format(problem=problem)))
+
+    async def get(self, problem: str) -> RejudgeRecord | None:
+        if self.client is None:
+            return self._records.get(problem)
+
+        raw = await self.client.get(self.key.format(problem=problem))
+        return RejudgeRecord.model_validate_json(raw) if raw is not None else None
+
+    async def set_state(self, problem: str, state: RejudgeState):
+        record = await self.get(problem)
+        if record is None:
+            return
+
+        record.state = state
+        if self.client is not None:
+            await self.client.set(self.key.format(problem=problem), record.model_dump_json())
+
+    async def push(self, problem: str, job_id: str):
+        if self.client is None:
+            self._jobs.setdefault(problem, []).append(job_id)
+            return
+        await self.client.rpush(self.jobs_key.format(problem=problem), job_id)
+
+    async def jobs(self, problem: str) -> list[str]:
+        if self.client is None:
+            return list(self._jobs.get(problem, []))
+        return [job_id.decode() for job_id in await self.client.lrange(self.jobs_key.format(problem=problem), 0, -1)]
+
+
+class Rejudge:
+    """
+    Enqueueing of one rejudge, in the worker that started it
+    """
+    store: RejudgeStore
+    record: RejudgeRecord
+    submissions: list[str]
+
+    def __init__(self, store: RejudgeStore, record: RejudgeRecord, submissions: list[str]):
+        self.store = store
+        self.record = record
+        self.submissions = submissions
+
+    async def _cancelled(self) -> bool:
+        record = await self.store.get(self.record.problem)
+        return record is None or record.state != "running"
+
+    async def run(self, enqueue: typing.Callable[[str], typing.Awaitable[str]]):
+        """
+        Enqueue every submission, at most `rate` per second, until any worker cancels the rejudge
+        """
+        problem = self.record.problem
+        interval = 1 / self.record.rate
+        try:
+            for submission_id in self.submissions:
+                started = time.monotonic()
+                if await self._cancelled():
+                    return
+
+                await self.store.push(problem, await enqueue(submission_id))
+                await self.store.renew(problem, lease(self.record.rate))
+                await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+        except asyncio.CancelledError:
+            await self.store.set_state(problem, "cancelled")
+            raise
+
+        except Exception as error:
+            logger.error(f"Rejudge of problem {problem} raise exception, detail")
+            logger.exception(error)
+            await self.store.set_state(problem, "failed")
+
+        finally:
+            await self.store.release(problem)
@@ -0,0 +1,99 @@
+"""
+Cache of judge verdicts, so identical code on unchanged testcases is not judged twice
+"""
+
+import collections
+import hashlib
+import json
+import os
+import time
+
+import pydantic
+import redis.asyncio as redis
+
+import db
+import declare
+import utils
+
+# Progress messages that belong to one judge run, not to the verdict
+skipped = ['waiting', 'requeued', 'catched', 'cached', 'overall', 'cancelled']
+
+
+class Verdict(declare.PydanticIndexable):
+    result: dict
+    logs: list
+    created_at: float = pydantic.Field(default_factory=time.time)
+
+
+def normalize(source: str) -> str:
+    """
+    Ignore line endings and trailing whitespace
+    """
+    return "\n".join(line.rstrip() for line in source.replace("\r\n", "\n").split("\n")).strip("\n")
+
+
+def key(submission: db.DBSubmissions, problem: db.DBProblems) -> str | None:
+    """
+    Hash of everything the verdict depends on, None when the source cannot be read
+    """
+    source = utils.read(submission.file_path) if submission.file_path else None
+    if source is None:
+        return None
+
+    judger = utils.read(os.path.join(problem.dir, "judger.py")) or ""
+    payload = json.dumps(
+        [
+            normalize(source),
+            submission.lang,
+            submission.compiler,
+            db.manifest.digest(problem),
+            problem.limit,
+            problem.mode,
+            problem.test_type,
+            problem.test_name,
+            problem.point_per_testcase,
+            problem.stop_on_first_failure,
+            hashlib.sha256(judger.encode()).hexdigest()
+        ],
+        sort_keys=True,
+        default=lambda value: value.model_dump() if isinstance(value, pydantic.BaseModel) else str(value)
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def cacheable(result: db.declare.SubmissionResult) -> bool:
+    return result.status not in [declare.StatusCode.SYSTEM_ERROR.value, declare.StatusCode.ABORTED.value]
+
+
+class VerdictCache:
+    """
+    Stored in Redis with a TTL, or in a bounded in-process map without it
+    """
+    key: str = "judge:verdict:{key}"
+
+    client: redis.Redis | None
+    _local: collections.OrderedDict[str, Verdict]
+
+    def __init__(self, client: redis.Redis = None):
+        self.client = client
+        self._local = collections.OrderedDict()
+
+    async def get(self, key: str) -> Verdict | None:
+        if self.client is None:
+            if key not in self._local:
+                return None
+            self._local.move_to_end(key)
+            return self._local[key]
+
+        raw = await self.client.get(self.key.format(key=key))
+        return Verdict.model_validate_json(raw) if raw is not None else None
+
+    async def set(self, key: str, verdict: Verdict):
+        if self.client is None:
+            self._local[key] = verdict
+            self._local.move_to_end(key)
+            while len(self._local) > utils.config.verdict_cache_size:
+                self._local.popitem(last=False)
+            return
+
+        await self.client.set(self.key.format(key=key), verdict.model_dump_json(), ex=utils.config.verdict_cache_ttl)
@@ -38,7 +38,7 @@ class InjectHandler(logging.Handler):
 def start(*args):
     if db.queue_manager:
         global queue
-        queue = db.queue_manager.create("admin")
+        queue = db.queue_manager.create("admin", maxlen=utils.config.admin_log_size)
 
 
 def inject():
@@ -71,6 +71,22 @@ async def get_log():
     return await queue.get_all()
 
 
+@admin_router.post("/logs/convert",
+                   summary="Convert submission logs to the archive format",
+                   responses={
+                       200: {
+                           "description": "Success",
+                           "content": {
+                               "application/json": {
+                                   "example": {"converted": 0}
+                               }
+                           }
+                       }
+                   })
+async def convert_logs():
+    return {"converted": await asyncio.to_thread(db.convert_logs)}
+
+
 @admin_router.websocket("/log/ws")
 async def get_log_ws(websocket: fastapi.WebSocket):
     await websocket.accept()
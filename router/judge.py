@@ -1,6 +1,7 @@
 import asyncio
 import json
 import logging
+import math
 
 from fastapi import APIRouter, HTTPException, status, WebSocket, Depends
 
@@ -12,8 +13,14 @@ import utils
 
 thread_manager: utils.ThreadingManager
 judge_manger: judge.JudgeManager
-loop: asyncio.Task
-heartbeat: asyncio.Task
+loop: asyncio.Task = None
+heartbeat: asyncio.Task = None
+sweeper: asyncio.Task = None
+pump: asyncio.Task = None
+commands: asyncio.Task = None
+leader: judge.Leader = None
+campaign: asyncio.Task = None
+dispatcher: asyncio.Task = None
 queue_manager: db.queue_manager
 logger: logging.Logger = logging.getLogger("justyse.router.judge")
 logger.propagate = False
@@ -21,14 +28,36 @@ logger.addHandler(utils.console_handler("Judge router"))
 
 
 async def start(*args):
-    global loop, heartbeat, queue_manager, judge_manger
+    global queue_manager, judge_manger, leader, campaign, dispatcher
     # thread_manager = thread_manager_
     queue_manager = db.queue_manager
 
     logger.info("Starting judge services...")
 
     judge_manger = judge.JudgeManager()
+    if judge_manger.coordinated:
+        leader = judge.Leader(db.redis_client)
+        campaign = asyncio.create_task(leader.campaign())
+        dispatcher = asyncio.create_task(follow())
+        logger.info("Election is started")
+    else:
+        await lead()
+
+    logger.info("Services are started.")
+
+
+async def lead():
+    """
+    Own the judge connections and dispatch the queue
+    """
+    global loop, heartbeat, sweeper, pump, commands
+
+    judge_manger.stop.clear()
+    judge_manger.leading = True
+
     await judge_manger.from_json()
+    if queue_manager is not None:
+        await judge_manger.recover()
 
     loop = asyncio.create_task(judge_manger.loop())
     logger.info("Loop is started")
@@ -36,37 +65,125 @@ async def start(*args):
     heartbeat = asyncio.create_task(judge_manger.heartbeat())
     logger.info("Heartbeat is started")
 
-    logger.info("Services are started.")
+    if queue_manager is not None:
+        sweeper = asyncio.create_task(judge_manger.sweeper())
+        logger.info("Sweeper is started")
 
+    if judge_manger.coordinated:
+        pump = asyncio.create_task(judge_manger.pump())
+        logger.info("Pump is started")
 
-async def stop(*args):
-    logger.info("Killing services...")
+        commands = asyncio.create_task(judge_manger.commands())
+        logger.info("Command listener is started")
 
-    judge_manger.stop.set()
 
-    loop.cancel()
+async def _cancel(task: asyncio.Task | None, name: str):
+    if task is None:
+        return
+    task.cancel()
     try:
-        await loop
+        await task
     except asyncio.CancelledError:
         pass
-    logger.info("Loop is stopped")
+    logger.info(f"{name} is stopped")
 
-    heartbeat.cancel()
-    try:
-        await heartbeat
-    except asyncio.CancelledError:
-        pass
-    logger.info("Heartbeat is stopped")
+
+async def step_down(rejudge: bool = False, drain: bool = False):
+    """
+    Stop dispatching and close the judge connections.
+    With drain, running judges get judge_drain_timeout seconds to finish first.
+    """
+    global loop, heartbeat, sweeper, pump, commands
+
+    # Nothing new is dispatched from here
+    await _cancel(loop, "Loop")
+    await _cancel(pump, "Pump")
+    if drain:
+        await judge_manger.drain()
+
+    judge_manger.stop.set()
+
+    await _cancel(heartbeat, "Heartbeat")
+    await _cancel(sweeper, "Sweeper")
+    await _cancel(commands, "Command listener")
+    loop = heartbeat = sweeper = pump = commands = None
 
     # thread_manager.close_timers("judge_manager.timers.*", True)
     # logger.info("Timers are stopped")
 
-    await judge_manger.stop_tasks()
+    await judge_manger.stop_tasks(rejudge)
     logger.info("Tasks are stopped")
 
+    await judge_manger.retire()
+
     await judge_manger.disconnects()
     logger.info("Connections are closed")
 
+
+async def stand_down():
+    """
+    Step down and forget the dispatch state, the jobs stay in Redis for the next dispatcher
+    """
+    try:
+        await step_down()
+    except Exception as error:
+        logger.error("Step down raise exception, detail")
+        logger.exception(error)
+
+    judge_manger.reset()
+    judge_manger.leading = False
+
+
+async def follow():
+    """
+    Dispatch while elected, hand the jobs over when the lock is lost
+    """
+    while True:
+        await leader.elected.wait()
+        try:
+            await lead()
+
+        except Exception as error:
+            # Renewing the lock while not dispatching would stall every judge
+            logger.error("Taking over the judge dispatch raise exception, detail")
+            logger.exception(error)
+            await stand_down()
+            try:
+                await leader.release()
+            except Exception as error:
+                logger.error("Release dispatcher lock raise exception, detail")
+                logger.exception(error)
+
+            # Tried again once the campaign elects this worker, or another one
+            continue
+
+        await leader.deposed.wait()
+        logger.warning("Lost the judge dispatcher lock, stepping down...")
+        await stand_down()
+
+
+async def stop(*args):
+    logger.info("Killing services...")
+    judge_manger.closing = True
+
+    await _cancel(dispatcher, "Dispatcher")
+
+    if judge_manger.leading:
+        await step_down(rejudge=True, drain=True)
+    else:
+        await judge_manger.stop_tasks()
+        logger.info("Tasks are stopped")
+
+    # Renewed while draining, so no other worker takes over the running judges
+    await _cancel(campaign, "Election")
+
+    # Jobs left by drain and their queues stay open for the next dispatcher, queue_manager.stop must not close them
+    judge_manger.reset()
+
+    if leader is not None and leader.is_leader:
+        await leader.release()
+        logger.info("Dispatcher lock is released")
+
     if queue_manager:
         await queue_manager.stop()
 
@@ -80,11 +197,71 @@ Judge
 """
 
 
+# GET
+@judge_router.get("/queue",
+                  summary="Get judge queue status",
+                  dependencies=[Depends(utils.has_permission("judge:queue"))],
+                  responses={
+                      200: {
+                          "description": "Depth, age of the oldest job, average wait, limit (0 for none) "
+                                         "and estimated wait of a new job (seconds) of each class",
+                          "content": {
+                              "application/json": {
+                                  "example": {
+                                      "contest": {"depth": 0, "oldest": 0, "wait": 0, "limit": 0, "estimate": 0},
+                                      "normal": {"depth": 2, "oldest": 3.2, "wait": 1.5, "limit": 100, "estimate": 4},
+                                      "rejudge": {"depth": 0, "oldest": 0, "wait": 0, "limit": 0, "estimate": 4},
+                                      "background": {"depth": 0, "oldest": 0, "wait": 0, "limit": 0, "estimate": 4}
+                                  }
+                              }
+                          }
+                      }
+                  })
+async def judge_queue():
+    return await judge_manger.queue_status()
+
+
+@judge_router.get("/queue/admission",
+                  summary="Get judge queue admission status",
+                  dependencies=[Depends(utils.has_permission("judge:queue"))],
+                  responses={
+                      200: {
+                          "description": "Waiting jobs, their limit (0 for none), jobs finished per second "
+                                         "and estimated wait of a new job in seconds (null while nothing finished)",
+                          "content": {
+                              "application/json": {
+                                  "example": {"depth": 2, "limit": 500, "drain_rate": 0.5, "estimate": 4}
+                              }
+                          }
+                      }
+                  })
+async def judge_queue_admission():
+    return await judge_manger.admission()
+
+
+@judge_router.get("/queue/users",
+                  summary="Get outstanding jobs of each user",
+                  dependencies=[Depends(utils.has_permission("judge:queue"))],
+                  responses={
+                      200: {
+                          "description": "Waiting and running jobs of every user with outstanding jobs",
+                          "content": {
+                              "application/json": {
+                                  "example": {
+                                      "user_id": {"waiting": 3, "running": 1}
+                                  }
+                              }
+                          }
+                      }
+                  })
+async def judge_queue_users():
+    return await judge_manger.queue_users()
+
+
 # POST
 @judge_router.post("/{id}",
                    summary="Add submission to judge queue",
                    status_code=status.HTTP_201_CREATED,
-                   dependencies=[Depends(utils.has_permission("submission:judge"))],
                    responses={
                        201: {
                            "description": "Submission added to judge queue",
@@ -117,6 +294,34 @@ Judge
                                }
                            }
                        },
+                       403: {
+                           "description": "Permission denied",
+                           "content": {
+                               "application/json": {
+                                   "example": {
+                                       "message": "Permission denied",
+                                       "code": "permission_denied",
+                                       "detail": {
+                                           "missing": "judge:priority"
+                                       }
+                                   }
+                               }
+                           }
+                       },
+                       429: {
+                           "description": "Judge queue is full, retry after the seconds in the Retry-After header",
+                           "content": {
+                               "application/json": {
+                                   "example": {
+                                       "message": "Judge queue is full",
+                                       "code": "queue_full",
+                                       "detail": {
+                                           "retry_after": 12
+                                       }
+                                   }
+                               }
+                           }
+                       },
                        503: {"description": "Redis not connected",
                              "content": {"application/json": {"example": {"message": "Redis not connected"}}}},
                        500: {
@@ -136,10 +341,34 @@ Judge
                            }
                        }
                    })
-async def submission_judge(id: str):
+async def submission_judge(id: str,
+                           priority: judge.Priority = "normal",
+                           cache: bool = True,
+                           user: db.DBUser = Depends(utils.has_permission("submission:judge"))):
     if queue_manager is None:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail={"message": "Redis not connected"})
 
+    if priority == "contest" and not db.has_permission(user, "judge:priority"):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail={
+            "message": "Permission denied",
+            "code": "permission_denied",
+            "detail": {
+                "missing": "judge:priority"
+            }
+        })
+
+    retry_after = await judge_manger.admit(priority)
+    if retry_after is not None:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail={
+                                "message": "Judge queue is full",
+                                "code": "queue_full",
+                                "detail": {
+                                    "retry_after": math.ceil(retry_after)
+                                }
+                            },
+                            headers={"Retry-After": str(math.ceil(retry_after))})
+
     submission: db.DBSubmissions = None
     problem: db.DBProblems = None
 
@@ -162,21 +391,19 @@ async def submission_judge(id: str):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=utils.InternalServerError)
 
     # judge_id = str(uuid.uuid4()).split('-')[0]
-    check = 0
-    judge_id = utils.rand_uuid(1)
-    while queue_manager.check(f"judge::{submission.id}:{judge_id}"):
-        judge_id = utils.rand_uuid(1)
-        check += 1
-        if check > 1000000:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail={"message": "Out of judge id"}
-            )
-    queue_id = f"{submission.id}:{judge_id}"
+    queue_id = await judge_manger.new_queue_id(submission.id)
+    if queue_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail={"message": "Out of judge id"}
+        )
 
     await judge_manger.add_submission(
         submission.id,
         queue_manager.create(f"judge::{queue_id}"),
+        priority,
+        submission.by,
+        cache,
         # asyncio.Event()
     )
     return queue_id
@@ -201,8 +428,8 @@ async def submission_judge_ws(id: str, ws: WebSocket):
         return await ws.close(status.WS_1008_POLICY_VIOLATION, "invalid id")
 
     try:
-        logs = db.get_logs(submission_id, queue_id)
-        for log in logs.logs:
+        logs = db.iter_logs(submission_id, queue_id)
+        for log in logs:
             pad_log = utils.padding(log, 2)
             await ws.send_json({
                 "status": pad_log[0],
@@ -218,8 +445,8 @@ async def submission_judge_ws(id: str, ws: WebSocket):
         pass
 
     msg_queue: db.redis.RedisQueue
-    if queue_manager.check(queue_id):
-        msg_queue = queue_manager.get(queue_id)
+    if await queue_manager.exists(queue_id):
+        msg_queue = await queue_manager.open(queue_id)
 
     # elif await queue_manager.check_cache(queue_id):
     #     msg_queue = await queue_manager.get_cache(queue_id)
@@ -261,7 +488,8 @@ async def submission_judge_ws(id: str, ws: WebSocket):
 
     @msg_queue.on('put')
     async def broadcast_msg(msg: str):
-        if loop.done():
+        # Followers have no loop, the elected worker writes the progress
+        if judge_manger.closing or (loop is not None and loop.done()):
             return await ws.close(status.WS_1011_INTERNAL_ERROR, "judge loop is aborted")
 
         msg = json.loads(msg)
@@ -297,11 +525,10 @@ server_router = APIRouter(prefix="/server", tags=["server"])
 # GET
 @server_router.get("s",
                    summary="Get all servers",
-                   response_model=list[dict[str, str]],
+                   response_model=list[dict],
                    dependencies=[Depends(utils.has_permission("judge_server:view"))])
-def judge_servers():
-    return [{"id": connection.id, "name": connection.name, "status": connection.status()}
-            for _, connection in judge_manger._connections.items()]
+async def judge_servers():
+    return await judge_manger.servers()
 
 
 # POST
@@ -322,7 +549,7 @@ def judge_servers():
                         }
                     })
 async def server_add(server: judge.data.Server):
-    if server.id in judge_manger._connections:
+    if judge_manger.has_server(server.id):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail={
                                 "message": "Server already exists",
@@ -350,7 +577,7 @@ async def server_add(server: judge.data.Server):
                         }
                     })
 async def server_pause(id: str):
-    if id not in judge_manger._connections:
+    if not judge_manger.has_server(id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail={
                                 "message": "Server not found",
@@ -378,7 +605,7 @@ async def server_pause(id: str):
                         }
                     })
 async def server_resume(id: str):
-    if id not in judge_manger._connections:
+    if not judge_manger.has_server(id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail={
                                 "message": "Server not found",
@@ -406,7 +633,7 @@ async def server_resume(id: str):
                         }
                     })
 async def server_disconnect(id: str):
-    if id not in judge_manger._connections:
+    if not judge_manger.has_server(id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail={
                                 "message": "Server not found",
@@ -434,7 +661,7 @@ async def server_disconnect(id: str):
                         }
                     })
 async def server_reconnect(id: str):
-    if id not in judge_manger._connections:
+    if not judge_manger.has_server(id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail={
                                 "message": "Server not found",
@@ -463,7 +690,7 @@ async def server_reconnect(id: str):
                           }
                       })
 async def server_delete(id: str):
-    if id not in judge_manger._connections:
+    if not judge_manger.has_server(id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail={
                                 "message": "Server not found",
@@ -1,3 +1,4 @@
+import asyncio
 import csv
 import logging
 
@@ -5,7 +6,9 @@ from fastapi import status, HTTPException, UploadFile, APIRouter, Depends
 from fastapi.responses import RedirectResponse, FileResponse
 
 import db
+import judge
 import utils
+from . import judge as judge_api
 
 problem_router = APIRouter(prefix="/problem", tags=["problem"])
 logger = logging.getLogger("justyse.router.problem")
@@ -80,6 +83,8 @@ def get_problems(
                         conditions.append(problem.point_per_testcase == float(value))
                     # elif item == "judger":
                     #     conditions.append(problem.judger == value)
+                    elif item == "stop_on_first_failure":
+                        conditions.append(problem.stop_on_first_failure == (value == "true"))
                     elif item == "roles":
                         conditions.append(problem.roles == value.split(';'))
                     else:
@@ -371,6 +376,34 @@ def get_problems_statics(to_file: bool = True, redirect: bool = True, download:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=utils.InternalServerError)
 
 
+@problem_router.get("/{id}/rejudge",
+                    summary="Get rejudge progress",
+                    response_model=judge.RejudgeProgress,
+                    dependencies=[Depends(utils.has_permission("problem:rejudge"))],
+                    responses={
+                        404: {
+                            "description": "Rejudge not found",
+                            "content": {
+                                "application/json": {
+                                    "example": {
+                                        "message": "Rejudge not found",
+                                        "code": "rejudge_not_found"
+                                    }
+                                }
+                            }
+                        }
+                    })
+async def get_problem_rejudge(id: str):
+    try:
+        return await judge_api.judge_manger.rejudge_progress(id)
+
+    except judge.exception.RejudgeNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={"message": "Rejudge not found", "code": "rejudge_not_found"}
+        )
+
+
 # POST
 @problem_router.post("",
                      summary="Add problem",
@@ -610,6 +643,65 @@ def add_problem_testcases(id: str, file: UploadFile):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=utils.InternalServerError)
 
 
+@problem_router.post("/{id}/rejudge",
+                     summary="Rejudge problem submissions",
+                     status_code=status.HTTP_202_ACCEPTED,
+                     response_model=judge.RejudgeProgress,
+                     dependencies=[Depends(utils.has_permission("problem:rejudge"))],
+                     responses={
+                         404: {
+                             "description": "Problem not found",
+                             "content": {
+                                 "application/json": {
+                                     "example": {
+                                         "message": "Problem not found",
+                                         "code": "problem_not_found"
+                                     }
+                                 }
+                             }
+                         },
+                         409: {
+                             "description": "Rejudge is running",
+                             "content": {
+                                 "application/json": {
+                                     "example": {
+                                         "message": "Rejudge is running",
+                                         "code": "rejudge_running"
+                                     }
+                                 }
+                             }
+                         },
+                         503: {"description": "Redis not connected",
+                               "content": {"application/json": {"example": {"message": "Redis not connected"}}}},
+                     })
+async def problem_rejudge(id: str, filter: judge.RejudgeFilter | None = None):
+    if judge_api.queue_manager is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail={"message": "Redis not connected"})
+
+    try:
+        filter = filter or judge.RejudgeFilter()
+        db.get_problem(id)
+        submissions = await asyncio.to_thread(judge.rejudge.select, id, filter)
+        return await judge_api.judge_manger.rejudge(id, submissions, filter.rate, filter.cache)
+
+    except db.exception.ProblemNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={"message": "Problem not found", "code": "problem_not_found"}
+        )
+
+    except judge.exception.RejudgeRunning:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"message": "Rejudge is running", "code": "rejudge_running"}
+        )
+
+    except Exception as error:
+        logger.error(f'rejudge problem {id} raise error, detail')
+        logger.exception(error)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=utils.InternalServerError)
+
+
 # PATCH
 @problem_router.patch("/{id}",
                       summary="Update problem",
@@ -862,3 +954,31 @@ def problem_delete(id: str):
         logger.error(f'delete problem {id} raise error, detail')
         logger.exception(error)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=utils.InternalServerError)
+
+
+@problem_router.delete("/{id}/rejudge",
+                       summary="Cancel rejudge",
+                       response_model=judge.RejudgeProgress,
+                       dependencies=[Depends(utils.has_permission("problem:rejudge"))],
+                       responses={
+                           404: {
+                               "description": "Rejudge not found",
+                               "content": {
+                                   "application/json": {
+                                       "example": {
+                                           "message": "Rejudge not found",
+                                           "code": "rejudge_not_found"
+                                       }
+                                   }
+                               }
+                           }
+                       })
+async def problem_rejudge_cancel(id: str):
+    try:
+        return await judge_api.judge_manger.cancel_rejudge(id)
+
+    except judge.exception.RejudgeNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={"message": "Rejudge not found", "code": "rejudge_not_found"}
+        )
@@ -30,17 +30,58 @@ class Config(PydanticIndexable):
     password_length: tuple[int, int] = pydantic.Field(default=(6, 128))
 
     container_port: int
-    redis_server: str
+    redis_server: str = pydantic.Field(default="redis://localhost:6379")
+    queue_backend: typing.Literal["list", "stream", "memory"] = pydantic.Field(default="list")
+    stream_maxlen: int = pydantic.Field(default=10000)
+    queue_ttl: int = pydantic.Field(default=3600)
+    queue_sweep_interval: int = pydantic.Field(default=300)
+    admin_log_size: int = pydantic.Field(default=1000)
 
     judge_server: typing.List[str] = pydantic.Field(default=None)
-    judge_mode: typing.Literal[0, 1]
+    judge_mode: typing.Literal[0, 1, 2]
     testcase_strict: typing.Literal["strict", "delete", "warn", "ignore"]
-    # compress_threshold: int
+    # Bytes of testcase content in a binary frame above which it is compressed, 0 to never compress.
+    # Only used when the judge server did not accept permessage-deflate
+    compress_threshold: int = pydantic.Field(default=65536)
+    # Testcases sent to a judge server before waiting for their acks
+    testcase_window: int = pydantic.Field(default=16)
+    # Testsets up to this many bytes are sent in one message
+    testcase_bulk_size: int = pydantic.Field(default=1048576)
     reconnect_timeout: int = pydantic.Field(default=10)
     recv_timeout: int = pydantic.Field(default=5)
+    # Seconds to wait for command.capabilities, servers that do not answer have no protocol extensions
+    capabilities_timeout: float = pydantic.Field(default=1)
     send_timeout: int = pydantic.Field(default=5)
     max_retry: int = pydantic.Field(default=5)
     heartbeat_interval: int = pydantic.Field(default=5)
+    queue_buffer_size: int = pydantic.Field(default=256)
+    queue_batch_delay: int = pydantic.Field(default=5)
+    judge_visibility_timeout: int = pydantic.Field(default=1800)
+    # Seconds running judges get to finish on shutdown, 0 to stop them at once
+    judge_drain_timeout: int = pydantic.Field(default=30)
+    # Only one API worker, elected through Redis, dispatches judge jobs. Needs the stream queue backend
+    judge_coordinator: bool = pydantic.Field(default=False)
+    # Seconds the elected worker keeps the dispatcher lock without renewing it
+    judge_leader_lease: int = pydantic.Field(default=5)
+    judge_priority_aging: int = pydantic.Field(default=60)
+    # Waiting submissions before new ones are turned away, 0 for no limit
+    judge_queue_limit: int = pydantic.Field(default=0)
+    # The same for each priority class
+    judge_class_limit: dict[str, int] = pydantic.Field(default_factory=dict)
+    # Seconds of finished jobs the drain rate is measured over
+    judge_drain_window: int = pydantic.Field(default=60)
+    # Submissions of one user judged at once, 0 for no limit
+    judge_user_concurrency: int = pydantic.Field(default=0)
+    ptps_batch_factor: int = pydantic.Field(default=2)
+    ptps_min_batch: int = pydantic.Field(default=1, ge=1)
+    rejudge_rate: float = pydantic.Field(default=5)
+    # Adaptive judge mode, in seconds
+    judge_session_overhead: float = pydantic.Field(default=1.0)
+    judge_default_test_time: float = pydantic.Field(default=1.0)
+    # Extra seconds a ptps chunk may take over its time limits before it is re-dispatched
+    judge_chunk_margin: float = pydantic.Field(default=10.0)
+    verdict_cache_ttl: int = pydantic.Field(default=604800)
+    verdict_cache_size: int = pydantic.Field(default=1024)
 
     capture_logger: list[str] = pydantic.Field(default=['justyse.*', 'uvicorn.*', 'fastapi'])
     logging_padding: int = pydantic.Field(default=15)